@@ -1,5 +1,5 @@
-from baseportal import BasePortal, BasePortalException
+from baseportal import BasePortal, BasePortalException, BasePortalOrderException, RetryPolicy, CircuitBreaker
 from smportal import SMPortal, SMPortalException
 from rhnclassic import RhnClassicPortal, RhnClassicPortalException
 
-__all__ = ['BasePortal', 'BasePortalException', 'SMPortal', 'SMPortalException', 'RhnClassicPortal', 'RhnClassicPortalException']
+__all__ = ['BasePortal', 'BasePortalException', 'BasePortalOrderException', 'RetryPolicy', 'CircuitBreaker', 'SMPortal', 'SMPortalException', 'RhnClassicPortal', 'RhnClassicPortalException']
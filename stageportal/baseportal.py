@@ -9,6 +9,10 @@ import requests
 import json
 import time
 import datetime
+import random
+import threading
+import Queue
+import urlparse
 import ConfigParser
 
 
@@ -17,12 +21,225 @@ class BasePortalException(Exception):
     pass
 
 
+class BasePortalOrderException(BasePortalException):
+    """ Order was placed but its result is unusable (must not be re-sent) """
+    pass
+
+
+class RetryPolicy(object):
+    """
+    Retry policy for BasePortal._retr
+
+    Delay before attempt N+1 is sleep * factor * multiplier ** N (capped by
+    max_sleep), randomized by up to 'jitter' fraction. Retries stop when
+    maxtries is reached, when 'deadline' seconds passed since the first
+    attempt or when the error is classified as fatal (see fatal_codes).
+    Without deadline total sleep is capped by maxtries * sleep, so backoff
+    never waits longer than the fixed policy would. Waiting for an open
+    circuit breaker is only bounded by the deadline.
+    """
+
+    PRESETS = {'fixed': {'factor': 1, 'multiplier': 1, 'jitter': 0, 'fatal_codes': ()},
+               'backoff': {'factor': 0.25, 'multiplier': 2, 'max_sleep': 30, 'jitter': 0.5},
+               'fast': {'factor': 0.1, 'multiplier': 2, 'max_sleep': 5, 'jitter': 0.5, 'deadline': 60}}
+
+    def __init__(self, maxtries=None, factor=1, multiplier=1, max_sleep=None, jitter=0, deadline=None, fatal_codes=(401, 403)):
+        self.maxtries = maxtries
+        self.factor = factor
+        self.multiplier = multiplier
+        self.max_sleep = max_sleep
+        self.jitter = jitter
+        self.deadline = deadline
+        self.fatal_codes = fatal_codes
+
+    @classmethod
+    def preset(cls, name, **kwargs):
+        """ Create policy from preset with overrides """
+        if not name in cls.PRESETS:
+            raise BasePortalException("Unknown retry policy: %s" % name)
+        params = cls.PRESETS[name].copy()
+        for key in kwargs:
+            if kwargs[key] is not None:
+                params[key] = kwargs[key]
+        return cls(**params)
+
+    def delay(self, ntry, sleep):
+        """ Get delay before next attempt """
+        delay = sleep * self.factor * self.multiplier ** ntry
+        if self.max_sleep is not None:
+            delay = min(delay, self.max_sleep)
+        if self.jitter:
+            delay -= delay * self.jitter * random.random()
+        return delay
+
+    def is_fatal(self, res, err):
+        """ Check if failure should not be retried """
+        if res is not None and type(res) == requests.models.Response:
+            return res.status_code in self.fatal_codes
+        return getattr(err, 'code', None) in self.fatal_codes
+
+
+class CircuitBreaker(object):
+    """
+    Circuit breaker for one endpoint/function
+
+    Opens after 'threshold' consecutive backend failures, requests are held
+    back for 'reset_timeout' seconds (_retr waits as long as the call has
+    retry budget left) and then one probe request is let through
+    (half-open). Successful probe closes the breaker, failed one opens it
+    again.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, threshold=10, reset_timeout=30):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def is_failure(res, err):
+        """ Check if result means backend failure (not a client-side error) """
+        if err is not None:
+            code = getattr(err, 'code', None)
+            try:
+                return code is None or int(code) >= 500
+            except ValueError:
+                return True
+        if res is not None and type(res) == requests.models.Response:
+            return res.status_code >= 500
+        return False
+
+    def allow(self):
+        """ Check if request may be performed """
+        with self.lock:
+            if self.state == self.OPEN and time.time() - self.opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                self.probing = False
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.HALF_OPEN and not self.probing:
+                self.probing = True
+                return True
+            return False
+
+    def success(self):
+        """ Record successful request """
+        with self.lock:
+            self.state = self.CLOSED
+            self.failures = 0
+            self.probing = False
+
+    def failure(self):
+        """ Record failed request """
+        with self.lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.threshold:
+                self.state = self.OPEN
+                self.opened_at = time.time()
+            self.probing = False
+
+    def wait_time(self):
+        """ Seconds left until the breaker allows probing """
+        with self.lock:
+            if self.state != self.OPEN:
+                return 0
+            return max(0, self.reset_timeout - (time.time() - self.opened_at))
+
+
+class CallMetrics(object):
+    """ Per-function call statistics collected by BasePortal._retr """
+
+    MAX_SAMPLES = 10000
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stats = {}
+        self.sleep = 0.0
+
+    def _get(self, key):
+        """ Get (create) stats for key, must be called with lock held """
+        if not key in self.stats:
+            self.stats[key] = {'calls': 0, 'attempts': 0, 'retries': 0, 'heals': 0, 'failures': 0, 'sleep': 0.0, 'time': 0.0,
+                               'samples': [], 'nsamples': 0}
+        return self.stats[key]
+
+    def call(self, key, failed):
+        """ Record finished _retr call """
+        with self.lock:
+            stats = self._get(key)
+            stats['calls'] += 1
+            if failed:
+                stats['failures'] += 1
+
+    def attempt(self, key, latency):
+        """ Record one attempt and its latency """
+        with self.lock:
+            stats = self._get(key)
+            stats['attempts'] += 1
+            stats['time'] += latency
+            stats['nsamples'] += 1
+            if len(stats['samples']) < self.MAX_SAMPLES:
+                stats['samples'].append(latency)
+            else:
+                # reservoir sampling keeps memory bounded
+                idx = random.randint(0, stats['nsamples'] - 1)
+                if idx < self.MAX_SAMPLES:
+                    stats['samples'][idx] = latency
+
+    def retry(self, key, sleep):
+        """ Record retry and time spent sleeping before it """
+        with self.lock:
+            stats = self._get(key)
+            stats['retries'] += 1
+            stats['sleep'] += sleep
+            self.sleep += sleep
+
+    def heal(self, key):
+        """ Record heal func call """
+        with self.lock:
+            self._get(key)['heals'] += 1
+
+    @staticmethod
+    def _percentile(samples, pct):
+        """ Get percentile from sorted samples """
+        if samples == []:
+            return None
+        return samples[min(len(samples) - 1, int(len(samples) * pct / 100.0))]
+
+    def snapshot(self):
+        """ Get metrics snapshot (JSON-serializable) """
+        with self.lock:
+            result = {'sleep': self.sleep, 'functions': {}}
+            for key, stats in self.stats.items():
+                samples = sorted(stats['samples'])
+                result['functions'][key] = {'calls': stats['calls'],
+                                            'attempts': stats['attempts'],
+                                            'retries': stats['retries'],
+                                            'heals': stats['heals'],
+                                            'failures': stats['failures'],
+                                            'sleep': stats['sleep'],
+                                            'latency': {'p50': self._percentile(samples, 50),
+                                                        'p95': self._percentile(samples, 95),
+                                                        'p99': self._percentile(samples, 99),
+                                                        'max': samples[-1] if samples != [] else None,
+                                                        'total': stats['time']}}
+            return result
+
+
 class BasePortal(object):
     """ BasePortal """
 
-    def __init__(self, login='admin', password='admin', maxtries=40, insecure=None, api_url=None, portal_url=None, configfile=None):
+    def __init__(self, login='admin', password='admin', maxtries=40, insecure=None, api_url=None, portal_url=None, configfile=None, retry_policy=None):
         self.logger = logging.getLogger("python-stageportal")
         self.maxtries = maxtries
+        self.retry_policy = self._get_policy(retry_policy, 'backoff')
         self.insecure = insecure
         self.login = login
         self.password = password
@@ -52,6 +269,225 @@ class BasePortal(object):
                 self.logger.debug("Failed to get 'main/portal' setting from config file")
                 self.portal_url = None
 
+        try:
+            self.pool_size = self.config.getint('main', 'pool_size')
+        except:
+            self.logger.debug("Failed to get 'main/pool_size' setting from config file")
+            self.pool_size = 10
+
+        try:
+            self.timeout = self.config.getfloat('main', 'timeout')
+        except:
+            self.logger.debug("Failed to get 'main/timeout' setting from config file")
+            self.timeout = 120
+
+        try:
+            self.cache_ttl = self.config.getfloat('main', 'cache_ttl')
+        except:
+            self.logger.debug("Failed to get 'main/cache_ttl' setting from config file")
+            self.cache_ttl = 600
+
+        try:
+            self.login_ttl = self.config.getfloat('main', 'login_ttl')
+        except:
+            self.logger.debug("Failed to get 'main/login_ttl' setting from config file")
+            self.login_ttl = 1800
+
+        try:
+            self.login_heal_window = self.config.getfloat('main', 'login_heal_window')
+        except:
+            self.logger.debug("Failed to get 'main/login_heal_window' setting from config file")
+            self.login_heal_window = 30
+
+        try:
+            self.breaker_threshold = self.config.getint('main', 'breaker_threshold')
+        except:
+            self.logger.debug("Failed to get 'main/breaker_threshold' setting from config file")
+            self.breaker_threshold = 10
+
+        try:
+            self.breaker_reset = self.config.getfloat('main', 'breaker_reset')
+        except:
+            self.logger.debug("Failed to get 'main/breaker_reset' setting from config file")
+            self.breaker_reset = 30
+
+        self.session = self._create_session()
+        self._cache = {}
+        self._cache_lock = threading.Lock()
+        self._login_lock = threading.Lock()
+        self._login_session = None
+        self._login_time = 0
+        self.breakers = {}
+        self._breakers_lock = threading.Lock()
+        self._metrics = CallMetrics()
+
+    def _create_session(self):
+        """ Create HTTP session with keep-alive connection pool """
+        sess = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size)
+        sess.mount('http://', adapter)
+        sess.mount('https://', adapter)
+        return sess
+
+    def _cache_get(self, key):
+        """ Get value from identity cache, None if missing or expired """
+        with self._cache_lock:
+            if key in self._cache:
+                stamp, value = self._cache[key]
+                if time.time() - stamp < self.cache_ttl:
+                    return value
+                del self._cache[key]
+        return None
+
+    def _cache_set(self, key, value):
+        """ Put value to identity cache """
+        with self._cache_lock:
+            self._cache[key] = (time.time(), value)
+
+    def invalidate_cache(self, key=None):
+        """ Drop cached identity data (everything if key is None) """
+        with self._cache_lock:
+            if key is None:
+                self._cache.clear()
+            elif key in self._cache:
+                del self._cache[key]
+
+    def _parallel(self, func, items, workers=1):
+        """
+        Run func(item) for every item using up to 'workers' threads
+
+        Items are consumed lazily. Returns list of (result, exception)
+        tuples in input order, exceptions don't stop other items.
+        """
+        results = {}
+        # pylint: disable=W0703
+
+        def _run(idx, item):
+            """ Run func for one item """
+            try:
+                results[idx] = (func(item), None)
+            except Exception, err:
+                self.logger.debug("%s failed for %s: %s", func, item, err)
+                results[idx] = (None, err)
+
+        if workers <= 1:
+            for idx, item in enumerate(items):
+                _run(idx, item)
+            return [results[idx] for idx in range(len(results))]
+
+        work = Queue.Queue(maxsize=workers * 2)
+
+        def _worker():
+            """ Worker thread """
+            while True:
+                task = work.get()
+                if task is None:
+                    break
+                _run(*task)
+
+        threads = [threading.Thread(target=_worker) for _ in range(workers)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        try:
+            for idx, item in enumerate(items):
+                work.put((idx, item))
+        finally:
+            for thread in threads:
+                work.put(None)
+            for thread in threads:
+                thread.join()
+        return [results[idx] for idx in range(len(results))]
+
+    def _pipeline(self, items, stages, queue_size=100):
+        """
+        Run items through stages connected with bounded queues
+
+        'stages' is a list of (func, workers[, flush]) tuples. func(item)
+        returns a list of items for the next stage; flush(), if set, is called
+        once all items passed the stage and returns leftover items for the next
+        stage. Failures don't stop the pipeline, returns list of
+        (item, exception) tuples.
+        """
+        queues = [Queue.Queue(maxsize=queue_size) for _ in stages]
+        errors = []
+        stop = object()
+        # pylint: disable=W0703
+
+        def _forward(num, out):
+            """ Pass items to the next stage """
+            if num + 1 < len(stages):
+                for item in out or []:
+                    queues[num + 1].put(item)
+
+        def _worker(num):
+            """ Stage worker thread """
+            func = stages[num][0]
+            while True:
+                item = queues[num].get()
+                if item is stop:
+                    break
+                try:
+                    out = func(item)
+                except Exception, err:
+                    self.logger.debug("%s failed for %s: %s", func, item, err)
+                    errors.append((item, err))
+                    out = []
+                _forward(num, out)
+
+        threads = []
+        for num, stage in enumerate(stages):
+            stage_threads = [threading.Thread(target=_worker, args=(num,)) for _ in range(max(1, stage[1]))]
+            for thread in stage_threads:
+                thread.daemon = True
+                thread.start()
+            threads.append(stage_threads)
+        try:
+            for item in items:
+                queues[0].put(item)
+        finally:
+            for num, stage in enumerate(stages):
+                for thread in threads[num]:
+                    queues[num].put(stop)
+                for thread in threads[num]:
+                    thread.join()
+                if len(stage) > 2 and stage[2] is not None:
+                    try:
+                        _forward(num, stage[2]())
+                    except Exception, err:
+                        errors.append((None, err))
+        return errors
+
+    def _read_csv(self, csv_file, columns, comment_column='Name'):
+        """
+        Stream rows from CSV file
+
+        All 'columns' are checked to be present before the first row is
+        returned, rows with comment_column starting with '#' are skipped.
+        """
+        with open(csv_file) as fd:
+            data = csv.DictReader(fd)
+            missing = [column for column in columns if not column in (data.fieldnames or [])]
+            if missing != []:
+                raise BasePortalException("CSV file %s lacks required columns: %s" % (csv_file, ', '.join(missing)))
+            for row in data:
+                if row[comment_column].startswith('#'):
+                    self.logger.debug("Skipping %s" % row[comment_column])
+                    continue
+                yield row
+
+    def _expand_csv(self, csv_file, columns, parse=None):
+        """
+        Stream work items from CSV file with 'Name' and 'Count' columns
+
+        Yields (num, name, data) for every one of 'Count' items of a row, where
+        name is namified 'Name' and data is parse(row) (computed once per row).
+        """
+        for row in self._read_csv(csv_file, ['Name', 'Count'] + columns):
+            data = parse(row) if parse is not None else row
+            for num in range(1, int(row['Count']) + 1):
+                yield (num, self._namify(row['Name'], num), data)
+
     @staticmethod
     def _namify(name, row):
         """ name % row namification """
@@ -60,20 +496,116 @@ class BasePortal(object):
         except TypeError:
             return name
 
+    @staticmethod
+    def _get_policy(policy, default):
+        """ Get RetryPolicy from policy object or preset name """
+        if policy is None:
+            policy = default
+        if isinstance(policy, RetryPolicy):
+            return policy
+        return RetryPolicy.preset(policy)
+
+    @property
+    def metrics(self):
+        """ Call metrics snapshot """
+        return self._metrics.snapshot()
+
+    @staticmethod
+    def _metrics_key(func, args):
+        """ Metrics key: method and host for HTTP requests, function name otherwise """
+        name = getattr(func, '__name__', str(func))
+        if name in ['get', 'post', 'put', 'delete'] and args and isinstance(args[0], basestring):
+            return "%s %s" % (name.upper(), urlparse.urlparse(args[0]).netloc)
+        return name
+
+    @staticmethod
+    def _breaker_key(func, args):
+        """ Circuit breaker key: host for HTTP requests, function name otherwise """
+        name = getattr(func, '__name__', str(func))
+        if name in ['get', 'post', 'put', 'delete'] and args and isinstance(args[0], basestring):
+            return urlparse.urlparse(args[0]).netloc
+        return name
+
+    def get_breaker(self, key):
+        """ Get (create) circuit breaker for key, None if breakers are disabled """
+        if self.breaker_threshold <= 0:
+            return None
+        with self._breakers_lock:
+            if not key in self.breakers:
+                self.breakers[key] = CircuitBreaker(self.breaker_threshold, self.breaker_reset)
+            return self.breakers[key]
+
+    def breaker_states(self):
+        """ Get circuit breakers state: {key: (state, consecutive failures)} """
+        with self._breakers_lock:
+            return dict((key, (breaker.state, breaker.failures)) for key, breaker in self.breakers.items())
+
+    def _breaker_pause(self, key, max_wait=None):
+        """ Wait while circuit breaker for key is open (for bulk operations) """
+        breaker = self.breakers.get(key)
+        if breaker is None:
+            return
+        wait = breaker.wait_time()
+        if max_wait is not None:
+            wait = min(wait, max_wait)
+        if wait > 0:
+            self.logger.info("Circuit breaker for %s is open, pausing for %.1fs", key, wait)
+            time.sleep(wait)
+
     def _retr(self, func, check, sleep, blow_up, heal_func, *args, **kwargs):
-        """ retry logic """
+        """
+        retry logic
+
+        'retry_policy' keyword (RetryPolicy or preset name) overrides
+        self.retry_policy for this call and is not passed to func.
+        """
+        policy = self._get_policy(kwargs.pop('retry_policy', None), self.retry_policy)
+        maxtries = policy.maxtries if policy.maxtries is not None else self.maxtries
+        breaker_key = self._breaker_key(func, args)
+        breaker = self.get_breaker(breaker_key)
+        metrics_key = self._metrics_key(func, args)
         res = None
         ntry = 0
+        fatal = False
+        healed_fatal = False
+        started = time.time()
+        slept = 0
         self.logger.debug("Performing %s with args: %s kwargs %s" % (func, args, kwargs))
-        while ntry < self.maxtries:
+        while ntry < maxtries:
             exc_message = None
+            err = None
             res = None
+            if breaker is not None and not breaker.allow():
+                # wait for the breaker (this counts as an attempt) instead of failing while retry budget is left
+                exc_message = "Circuit breaker for %s is open" % breaker_key
+                self.logger.debug(exc_message)
+                ntry += 1
+                if ntry >= maxtries:
+                    break
+                wait = breaker.wait_time() or policy.delay(ntry - 1, sleep)
+                if policy.deadline is not None:
+                    left = policy.deadline - (time.time() - started)
+                    if left <= 0:
+                        fatal = True
+                        break
+                    wait = min(wait, left)
+                # not counted in the sleep budget: it is usually shorter than breaker_reset
+                self._metrics.retry(metrics_key, wait)
+                time.sleep(wait)
+                continue
             # pylint: disable=W0703
+            attempt_started = time.time()
             try:
                 res = func(*args, **kwargs)
             except Exception, err:
                 exc_message = "Exception during %s execution: %s" % (func, err)
                 self.logger.debug(exc_message)
+            self._metrics.attempt(metrics_key, time.time() - attempt_started)
+            if breaker is not None:
+                if CircuitBreaker.is_failure(res, err):
+                    breaker.failure()
+                else:
+                    breaker.success()
             try:
                 self.logger.debug("Checking %s after %s" , res, func)
                 if check(res):
@@ -81,36 +613,61 @@ class BasePortal(object):
                     break
                 else:
                     self.logger.debug("Checking: failed")
-            except Exception, err:
-                exc_message = "Checking: exception: %s" % err
+            except Exception, err_check:
+                exc_message = "Checking: exception: %s" % err_check
                 self.logger.debug(exc_message)
+            ntry += 1
+            if policy.is_fatal(res, err):
+                if heal_func is None or healed_fatal:
+                    self.logger.debug("Fatal error, not retrying %s", func)
+                    fatal = True
+                    break
+                # auth errors may be fixed by heal_func (e.g. portal login), give it one chance
+                healed_fatal = True
             if heal_func is not None:
                 self.logger.debug("Doing heal func %s", heal_func)
+                self._metrics.heal(metrics_key)
                 heal_func()
-            ntry += 1
-            time.sleep(sleep)
-        if ntry >= self.maxtries:
+            if ntry >= maxtries:
+                break
+            delay = policy.delay(ntry - 1, sleep)
+            if policy.deadline is not None and time.time() - started + delay > policy.deadline:
+                self.logger.debug("Deadline of %s seconds reached for %s", policy.deadline, func)
+                fatal = True
+                break
+            if policy.deadline is None:
+                delay = min(delay, max(0, maxtries * sleep - slept))
+            slept += delay
+            self._metrics.retry(metrics_key, delay)
+            time.sleep(delay)
+        self._metrics.call(metrics_key, ntry >= maxtries or fatal)
+        if ntry >= maxtries or fatal:
             if res is not None:
-                self.logger.error("%s (args: %s, kwargs %s) failed after %s tries, last result: %s", func, args, kwargs, self.maxtries, res)
+                self.logger.error("%s (args: %s, kwargs %s) failed after %s tries, last result: %s", func, args, kwargs, ntry, res)
                 if type(res) == requests.models.Response:
                     self.logger.debug("Request output: %s", res.text)
             elif exc_message is not None:
-                self.logger.error("%s (args: %s, kwargs %s) failed after %s tries, last exception: %s", func, args, kwargs, self.maxtries, exc_message)
+                self.logger.error("%s (args: %s, kwargs %s) failed after %s tries, last exception: %s", func, args, kwargs, ntry, exc_message)
             else:
-                self.logger.error("%s (args: %s, kwargs %s) failed after %s tries", func, args, kwargs, self.maxtries)
+                self.logger.error("%s (args: %s, kwargs %s) failed after %s tries", func, args, kwargs, ntry)
 
             if blow_up is True:
-                raise BasePortalException("%s (args: %s, kwargs: %s) failed after %s tries, last result: %s" % (func, args, kwargs, self.maxtries, res))
+                raise BasePortalException("%s (args: %s, kwargs: %s) failed after %s tries, last result: %s" % (func, args, kwargs, ntry, res))
             else:
                 res = None
         return res
 
     def get_user(self):
-        """ Get portal user """
+        """ Get portal user (webCustomerId) """
+        webcustomerid = self._cache_get('user')
+        if webcustomerid is not None:
+            return webcustomerid
 
         url = "%s/user/v3/login=%s" % (self.api_url, self.login)
-        user = self._retr(requests.get, lambda res: res.json()[0]['customer']['id'] is not None, 1, True, None, url)
-        return user.json()[0]['customer']['id']
+        user = self._retr(self.session.get, lambda res: res.json()[0]['customer']['id'] is not None, 1, True, None, url, timeout=self.timeout)
+        webcustomerid = user.json()[0]['customer']['id']
+        self._cache_set('user', webcustomerid)
+        return webcustomerid
 
     def create_user(self):
         """ Create portal user """
@@ -134,8 +691,8 @@ class BasePortal(object):
                                                 "county": "Wake",
                                                 "countryCode": "US",
                                                 "postalCode": "27606"}}}
-        return self._retr(requests.post, lambda res: int(res.content) is not None, 1,
-                          True, None, url, headers={"Content-Type": 'application/json'}, data=json.dumps(newuser)).content
+        return self._retr(self.session.post, lambda res: int(res.content) is not None, 1,
+                          True, None, url, headers={"Content-Type": 'application/json'}, data=json.dumps(newuser), timeout=self.timeout).content
 
     def activate(self, regnumber, start_date):
         """ Activate regNumber """
@@ -150,12 +707,47 @@ class BasePortal(object):
                 "webCustomerId": webcustomerid,
                 "systemName": "genie"
                 }
-        req = self._retr(requests.post, lambda res: res.json()['id'] is not None, 1,
-                         True, None, url, headers={"Content-Type": 'application/json'}, data=json.dumps(data))
+        req = self._retr(self.session.post, lambda res: res.json()['id'] is not None, 1,
+                         True, None, url, headers={"Content-Type": 'application/json'}, data=json.dumps(data), timeout=self.timeout)
         return req.json()['id']
 
-    def hock_sku(self, sku, quantity, start_date):
-        """ Place an order """
+    @staticmethod
+    def _hock_line(sku, quantity, start_date):
+        """ Hock order line """
+        return {"productSKU": sku,
+                "serviceTagHashed": False,
+                "additionalEmails": [],
+                "ccList": [],
+                "bccList": [],
+                "numSuperRegnums": 1,
+                "lineItem": {"sku": sku,
+                             "opUnit": "",
+                             "quantity": quantity,
+                             "zuper": True,
+                             "replicator": {"replicatorId": 30},
+                             "reason": {"id": "14"},
+                             "subject": "",
+                             "comments": "",
+                             "completed": False,
+                             "renew": False,
+                             "entitlementStartDate": start_date,
+                             "satelliteVersion": "",
+                             "poNumber": "",
+                             "salesOrderNumber": "",
+                             "emailCc": "",
+                             "emailBcc": "",
+                             "emailType": "ENDUSER",
+                             "recipient": "",
+                             "webContactId": "",
+                             "groupIdentifier": "",
+                             "duration": "1 year",
+                             "opUnitId": 103,
+                             "userAcctNumber": "",
+                             "partnerAcctNumber": "",
+                             "replicatorAcctNumber": ""}}
+
+    def _hock_order(self, lines):
+        """ Place an order, return regNumbers for all lines """
         url = "%s/regnum/v5/hock/order" % self.api_url
 
         webcustomerid = self.get_user()
@@ -197,74 +789,142 @@ class BasePortal(object):
                                        "group": "staff:pm:hock",
                                        "bccEmails": "dev-null@redhat.com",
                                        "addtEmails": "dev-null@redhat.com"}},
-                "lines": [{"productSKU": sku,
-                           "serviceTagHashed": False,
-                           "additionalEmails": [],
-                           "ccList": [],
-                           "bccList": [],
-                           "numSuperRegnums": 1,
-                           "lineItem": {"sku": sku,
-                                        "opUnit": "",
-                                        "quantity": quantity,
-                                        "zuper": True,
-                                        "replicator": {"replicatorId": 30},
-                                        "reason": {"id": "14"},
-                                        "subject": "",
-                                        "comments": "",
-                                        "completed": False,
-                                        "renew": False,
-                                        "entitlementStartDate": start_date,
-                                        "satelliteVersion": "",
-                                        "poNumber": "",
-                                        "salesOrderNumber": "",
-                                        "emailCc": "",
-                                        "emailBcc": "",
-                                        "emailType": "ENDUSER",
-                                        "recipient": "",
-                                        "webContactId": "",
-                                        "groupIdentifier": "",
-                                        "duration": "1 year",
-                                        "opUnitId": 103,
-                                        "userAcctNumber": "",
-                                        "partnerAcctNumber": "",
-                                        "replicatorAcctNumber": ""}}]}
-
-        order = self._retr(requests.put, lambda res: 'regNumbers' in res.json(), 1,
-                           True, None, url, headers={"Content-Type": 'application/json'}, data=json.dumps(data))
-        regnumber = order.json()['regNumbers'][0][0]['regNumber']
+                "lines": lines}
+
+        order = self._retr(self.session.put, lambda res: 'regNumbers' in res.json(), 1,
+                           True, None, url, headers={"Content-Type": 'application/json'}, data=json.dumps(data), timeout=self.timeout)
+        regnumbers = order.json()['regNumbers']
+        if len(regnumbers) != len(lines):
+            # order was placed, don't retry it
+            raise BasePortalOrderException("Order returned %s regNumbers for %s lines" % (len(regnumbers), len(lines)))
+        return [regnumber[0]['regNumber'] for regnumber in regnumbers]
+
+    def hock_sku(self, sku, quantity, start_date):
+        """ Place an order """
+        regnumber = self._hock_order([self._hock_line(sku, quantity, start_date)])[0]
         return self.activate(regnumber, start_date)
 
-    def add_skus(self, skus):
+    def add_skus(self, skus, workers=1, order_size=50):
         """
         Create SKUs
+
+        SKUs with the same start date are hocked with one multi-line order
+        (up to order_size lines), if the order fails its SKUs are hocked one
+        by one. Returns regNumber activation ids in input order, None for
+        SKUs which failed to hock or activate (errors are logged and don't
+        stop the batch).
         """
-        sku_added_list = []
-        for sku in skus:
-            sku_added_list.append(self.hock_sku(sku['Id'], sku['Quantity'], sku['Start Date']))
+        skus_read = []
+        orders = []
+
+        def _orders():
+            """ Group SKUs by start date, yield orders as soon as they are full """
+            pending = {}
+            for sku in skus:
+                if skus_read == []:
+                    # warm up webCustomerId cache before fanning out
+                    self.get_user()
+                pending.setdefault(sku['Start Date'], []).append(len(skus_read))
+                skus_read.append(sku)
+                if len(pending[sku['Start Date']]) >= order_size:
+                    orders.append(pending.pop(sku['Start Date']))
+                    yield orders[-1]
+            for order in sorted(pending.values()):
+                orders.append(order)
+                yield order
+
+        def _hock(order):
+            """ Hock order, fall back to single-line orders if it wasn't placed """
+            lines = [self._hock_line(skus_read[idx]['Id'], skus_read[idx]['Quantity'], skus_read[idx]['Start Date']) for idx in order]
+            # pylint: disable=W0703
+            try:
+                return self._hock_order(lines)
+            except BasePortalOrderException:
+                raise
+            except Exception, err:
+                if len(lines) == 1:
+                    raise
+                self.logger.info("Order with %s lines failed (%s), hocking SKUs one by one", len(lines), err)
+            regnumbers = []
+            for line in lines:
+                try:
+                    regnumbers.append(self._hock_order([line])[0])
+                except Exception, err:
+                    regnumbers.append(err)
+            return regnumbers
+
+        errors = {}
+        activations = []
+        order_results = self._parallel(_hock, _orders(), workers)
+        for order, (regnumbers, err) in zip(orders, order_results):
+            if err is not None:
+                for idx in order:
+                    errors[idx] = err
+                continue
+            for idx, regnumber in zip(order, regnumbers):
+                if isinstance(regnumber, Exception):
+                    errors[idx] = regnumber
+                else:
+                    activations.append((idx, regnumber))
+
+        sku_added_list = [None] * len(skus_read)
+        activation_results = self._parallel(lambda act: self.activate(act[1], skus_read[act[0]]['Start Date']), activations, workers)
+        for (idx, _), (res, err) in zip(activations, activation_results):
+            if err is not None:
+                errors[idx] = err
+            sku_added_list[idx] = res
+
+        for idx in sorted(errors):
+            sku = skus_read[idx]
+            self.logger.error("Failed to add SKU %s (quantity: %s, start date: %s): %s", sku['Id'], sku['Quantity'], sku['Start Date'], errors[idx])
         return sku_added_list
 
-    def add_skus_csv(self, csv_file):
+    def add_skus_csv(self, csv_file, workers=1):
         """
          CSV:
          Id, Quantity[, Start Date]
         """
-        sku_list = []
-        data = csv.DictReader(open(csv_file))
-        for row in data:
-            if row['Id'][0] == '#':
-                # skipping comments
-                continue
-            if 'Start Date' in row:
-                try:
-                    start_date = (datetime.datetime.now() + datetime.timedelta(int(row['Start Date']))).strftime("%Y-%m-%d")
-                except ValueError:
-                    start_date = row['Start Date']
-            else:
-                start_date = datetime.datetime.now().strftime("%Y-%m-%d")
-            sku_list.append({'Id': row['Id'], 'Quantity': row['Quantity'], 'Start Date': start_date})
-        return self.add_skus(sku_list)
+        def _skus():
+            """ SKUs from CSV file """
+            for row in self._read_csv(csv_file, ['Id', 'Quantity'], 'Id'):
+                if 'Start Date' in row:
+                    try:
+                        start_date = (datetime.datetime.now() + datetime.timedelta(int(row['Start Date']))).strftime("%Y-%m-%d")
+                    except ValueError:
+                        start_date = row['Start Date']
+                else:
+                    start_date = datetime.datetime.now().strftime("%Y-%m-%d")
+                yield {'Id': row['Id'], 'Quantity': row['Quantity'], 'Start Date': start_date}
+        return self.add_skus(_skus(), workers)
+
+    def portal_login(self, force=False):
+        """
+        Get logged in portal session
+
+        Session is cached for login_ttl seconds. Concurrent callers wait for
+        one in-flight login; forced login is skipped if somebody else logged
+        in while we were waiting.
+        """
+        if self.portal_url is None:
+            return None
+
+        requested = time.time()
+        with self._login_lock:
+            if self._login_session is not None and time.time() - self._login_time < self.login_ttl and \
+                    (not force or self._login_time >= requested):
+                return self._login_session
+            self._login_session = self._portal_login()
+            self._login_time = time.time()
+            return self._login_session
+
+    def _heal_login(self):
+        """ Heal func: re-login to portal, at most once per login_heal_window """
+        if self._login_session is not None and time.time() - self._login_time < self.login_heal_window:
+            self.logger.debug("Portal login was done %.1fs ago, skipping", time.time() - self._login_time)
+            return self._login_session
+        return self.portal_login(force=True)
 
-    def portal_login(self):
+    def _portal_login(self):
         """ Perform portal login, accept terms if needed """
         url = self.portal_url
 
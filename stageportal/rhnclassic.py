@@ -5,7 +5,6 @@
 import time
 import hashlib
 import xml.etree.ElementTree as ET
-import csv
 import requests
 import re
 from BeautifulSoup import BeautifulSoup
@@ -27,8 +26,9 @@ class RhnClassicPortalException(BasePortalException):
 class RhnClassicPortal(BasePortal):
     """ RhnClassicPortal """
 
-    def __init__(self, xmlrpc_url=None, login='admin', password='admin', maxtries=40, insecure=None, webui_url=None, api_url=None, portal_url=None, configfile=None):
-        BasePortal.__init__(self, login, password, maxtries, insecure, api_url, portal_url, configfile)
+    def __init__(self, xmlrpc_url=None, login='admin', password='admin', maxtries=40, insecure=None, webui_url=None, api_url=None, portal_url=None, configfile=None,
+                 retry_policy=None):
+        BasePortal.__init__(self, login, password, maxtries, insecure, api_url, portal_url, configfile, retry_policy)
 
         if xmlrpc_url is not None:
             self.xmlrpc_url = xmlrpc_url
@@ -262,7 +262,7 @@ class RhnClassicPortal(BasePortal):
         else:
             (sess, req) = self._retr(self._get_hosted_entitlements_page,
                                      lambda res: res[1].status_code == 200 and res[1].text.find('Software Channel Entitlements') != -1,
-                                     1, True, None)
+                                     1, True, self._heal_login)
         cnt = 0
         while True:
             self.logger.debug("Parsing page No %s with entitlements" % cnt)
@@ -353,6 +353,26 @@ class RhnClassicPortal(BasePortal):
                              "%s/rhn/channels/software/Entitlements.do" % self.webui_url, data=data)
         return result
 
+    @staticmethod
+    def _parse_system_row(row):
+        """ Parse systems CSV row """
+        try:
+            cores = int(row['Cores'])
+        except ValueError:
+            cores = None
+        try:
+            memory = int(row['RAM'])
+        except ValueError:
+            memory = None
+
+        channels = []
+        if row['Child Channels']:
+            channels = row['Child Channels'].split(';')
+
+        return {'cores': cores, 'memory': memory, 'arch': row['Arch'], 'release': row['Release'], 'version': row['Version'],
+                'org': row['Org Label'], 'basechannel': row['Base Channel'], 'channels': channels,
+                'is_guest': row['Virtual'] in ['Yes', 'Y', 'y'], 'host': row['Host']}
+
     def create_systems(self, csv_file, org=None):
         """
         Register a bunch of systems from CSV file
@@ -361,53 +381,22 @@ class RhnClassicPortal(BasePortal):
         """
         host_systems = {}
 
-        data = csv.DictReader(open(csv_file))
-        for row in data:
-            if row['Name'].startswith('#'):
-                self.logger.debug("Skipping %s" % row['Name'])
-                continue
-            num = 0
-            total = int(row['Count'])
-            try:
-                cores = int(row['Cores'])
-            except ValueError:
-                cores = None
-            try:
-                memory = int(row['RAM'])
-            except ValueError:
-                memory = None
-            arch = row['Arch']
-            release = row['Release']
-            version = row['Version']
-            org = row['Org Label']
-            basechannel = row['Base Channel']
-
-            channels = []
-            if row['Child Channels']:
-                channels = row['Child Channels'].split(';')
-
-            while num < total:
-                num += 1
-                name = self._namify(row['Name'], num)
-
-                if row['Virtual'] in ['Yes', 'Y', 'y']:
-                    is_guest = True
-                else:
-                    is_guest = False
-
-                if self.register_system(name, cores, memory, arch, release, version, is_guest, org, basechannel) is None:
-                    raise RhnClassicPortalException("Failed to register system %s" % name)
+        columns = ['Org Label', 'Virtual', 'Host', 'Release', 'Version', 'Arch', 'RAM', 'Cores', 'Base Channel', 'Child Channels']
+        for num, name, params in self._expand_csv(csv_file, columns, self._parse_system_row):
+            if self.register_system(name, params['cores'], params['memory'], params['arch'], params['release'], params['version'],
+                                    params['is_guest'], params['org'], params['basechannel']) is None:
+                raise RhnClassicPortalException("Failed to register system %s" % name)
 
-                if channels != []:
-                    if self._add_child_channels(name, channels) is None:
-                        raise RhnClassicPortalException("Failed to subscribe %s to %s" % (name, channels))
+            if params['channels'] != []:
+                if self._add_child_channels(name, params['channels']) is None:
+                    raise RhnClassicPortalException("Failed to subscribe %s to %s" % (name, params['channels']))
 
-                if row['Host'] is not None and row['Host'] != '':
-                    host_name = self._namify(row['Host'], num)
-                    if not host_name in host_systems:
-                        host_systems[host_name] = [name]
-                    else:
-                        host_systems[host_name].append(name)
+            if params['host'] is not None and params['host'] != '':
+                host_name = self._namify(params['host'], num)
+                if not host_name in host_systems:
+                    host_systems[host_name] = [name]
+                else:
+                    host_systems[host_name].append(name)
 
         self.logger.debug("Host/guest allocation: %s" % host_systems)
 
@@ -423,7 +412,8 @@ class RhnClassicPortal(BasePortal):
         """ Do up2date.login for system """
         if not system in self.systems:
             raise RhnClassicPortalException("System %s is not in systems list" % system)
-        headers = self._retr(self.rpc._request, lambda res: res is not None, 1, False, None, 'up2date.login', (self.systems[system]['details'], ))
+        headers = self._retr(self.rpc._request, lambda res: res is not None, 1, False, None, 'up2date.login', (self.systems[system]['details'], ),
+                             retry_policy='fast')
         if headers is not None:
             self.systems[system]['login_headers'] = headers.copy()
         return headers
@@ -438,5 +428,5 @@ class RhnClassicPortal(BasePortal):
             else:
                 self.logger.debug("Performing login for %s as requested", system)
             assert self.system_login(system) is not None, "Failed to perform up2date.login"
-        return requests.get("%s/GET-REQ/%s/getPackage/%s" % (self.xmlrpc_url, repo, package),
-                            headers=self.systems[system]['login_headers'], verify=verify)
+        return self.session.get("%s/GET-REQ/%s/getPackage/%s" % (self.xmlrpc_url, repo, package),
+                                headers=self.systems[system]['login_headers'], verify=verify, timeout=self.timeout)
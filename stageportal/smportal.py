@@ -3,18 +3,21 @@
 
 """ SubscriptionManagementPortal module """
 
-import requests
 import json
 import re
 import tempfile
 import os
 import time
-import csv
 import random
 import inspect
-from rhsm import connection
+import threading
+import ctypes
+import urlparse
+import hashlib
+from collections import OrderedDict
+from rhsm import connection, certificate
 
-from baseportal import BasePortal, BasePortalException
+from baseportal import BasePortal, BasePortalException, RetryPolicy
 
 
 class SMPortalException(BasePortalException):
@@ -22,11 +25,268 @@ class SMPortalException(BasePortalException):
     pass
 
 
+def _memfd_create(name):
+    """ Create anonymous in-memory file (Linux only), returns fd or None """
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        # MFD_CLOEXEC
+        fd = libc.memfd_create(name, 1)
+    except (OSError, AttributeError):
+        return None
+    if fd < 0:
+        return None
+    return fd
+
+
+class PemCredentials(object):
+    """
+    Cert/key pair usable as file paths (for rhsm and requests)
+
+    PEM data is kept in anonymous memfd files (/proc/self/fd/N) so keys are
+    never written to disk, temporary files are used when memfd is not
+    available. Files are released by close() or when the object is garbage
+    collected. A closed fd number is reused by the kernel, so whatever uses
+    the paths (connection, session) must keep a reference to the object.
+    """
+
+    def __init__(self, cert, key):
+        self.fds = []
+        self.tmpfiles = []
+        self.cert_file = self._store(cert)
+        self.key_file = self._store(key)
+
+    def _store(self, data):
+        """ Store PEM data, return path """
+        fd = _memfd_create('stageportal-pem')
+        if fd is not None:
+            self.fds.append(fd)
+            while data:
+                data = data[os.write(fd, data):]
+            return '/proc/self/fd/%d' % fd
+        tfile = tempfile.NamedTemporaryFile(delete=False, suffix=".pem")
+        tfile.write(data)
+        tfile.close()
+        self.tmpfiles.append(tfile.name)
+        return tfile.name
+
+    def close(self):
+        """ Release cert material """
+        for fd in self.fds:
+            os.close(fd)
+        for fname in self.tmpfiles:
+            if os.path.exists(fname):
+                os.unlink(fname)
+        self.fds = []
+        self.tmpfiles = []
+
+    def __del__(self):
+        # pylint: disable=W0702
+        try:
+            self.close()
+        except:
+            pass
+
+
+class LRUCache(object):
+    """ Thread-safe LRU cache, drop(value) is called for evicted values """
+
+    def __init__(self, size, drop=None):
+        self.size = size
+        self.drop = drop
+        self.lock = threading.Lock()
+        self.data = OrderedDict()
+
+    def get(self, key):
+        """ Get value (None if missing) and mark it as recently used """
+        with self.lock:
+            if not key in self.data:
+                return None
+            value = self.data.pop(key)
+            self.data[key] = value
+            return value
+
+    def put(self, key, value):
+        """ Put value, returns cached value if somebody was faster """
+        evicted = []
+        with self.lock:
+            if key in self.data:
+                evicted.append(value)
+                value = self.data[key]
+            else:
+                self.data[key] = value
+                while len(self.data) > self.size:
+                    evicted.append(self.data.popitem(last=False)[1])
+        for old in evicted:
+            self._drop(old)
+        return value
+
+    def pop(self, key):
+        """ Remove value """
+        with self.lock:
+            value = self.data.pop(key, None)
+        if value is not None:
+            self._drop(value)
+
+    def clear(self):
+        """ Remove all values """
+        with self.lock:
+            values = self.data.values()
+            self.data.clear()
+        for value in values:
+            self._drop(value)
+
+    def _drop(self, value):
+        """ Call drop func for value """
+        if self.drop is not None:
+            self.drop(value)
+
+
+class PoolCache(object):
+    """
+    Owner pools cache
+
+    Pools are fetched once per owner and kept until invalidate(), callers
+    reset the cache at the start of every run. 'consumed' is updated
+    locally after successful binds and detaches, single pool is refetched
+    when binding to it fails for lack of entitlements. Pools are indexed by
+    productId and split into master pools and derived pools (by
+    'requires_host' attribute) for suitable pools lookup. Products without
+    suitable pools are refetched at most once per run (see refetch_once).
+    """
+
+    def __init__(self, fetch_pools, fetch_pool):
+        self.fetch_pools = fetch_pools
+        self.fetch_pool = fetch_pool
+        self.lock = threading.Lock()
+        self.owners = {}
+        self.pools = {}
+        self.index = {}
+        self.refetched = set()
+
+    def get(self, owner):
+        """ Get owner pools """
+        with self.lock:
+            if owner in self.owners:
+                return self.owners[owner]
+        pools = []
+        index = {}
+        for pool in self.fetch_pools(owner):
+            pools.append(pool)
+            entry = index.setdefault(pool['productId'], {'master': [], 'derived': {}})
+            if pool.get('subscriptionSubKey') == 'master':
+                entry['master'].append(pool)
+            else:
+                entry['derived'].setdefault(self._required_host(pool), []).append(pool)
+        with self.lock:
+            self.owners[owner] = pools
+            self.index[owner] = index
+            for pool in pools:
+                self.pools[pool['id']] = pool
+        return pools
+
+    def suitable_pools(self, owners, productid, is_virtual, host_uuid=None):
+        """
+        Get ids of pools with free entitlements for productid
+
+        For virtual systems derived pools go first (latest first), then
+        master pools. Only derived pools of guest's host ('host_uuid') or
+        without host requirement are suitable. Physical systems only get
+        master pools.
+        """
+        master = []
+        derived = []
+        for owner in owners:
+            self.get(owner)
+            with self.lock:
+                entry = self.index.get(owner, {}).get(productid)
+                if entry is not None:
+                    master += [pool['id'] for pool in entry['master'] if self._available(pool)]
+                    for host in [None] + ([host_uuid] if host_uuid is not None else []):
+                        derived += [pool['id'] for pool in entry['derived'].get(host, []) if self._available(pool)]
+        if is_virtual in [True, 'true', 'True']:
+            return derived[::-1] + master
+        return master
+
+    @staticmethod
+    def _required_host(pool):
+        """ Host consumer uuid derived pool is restricted to (None if any) """
+        for attr in pool.get('attributes', []):
+            if attr['name'] == 'requires_host':
+                return attr['value']
+        return None
+
+    @staticmethod
+    def _available(pool):
+        """ Check if pool has free entitlements """
+        return pool['consumed'] < pool['quantity'] or pool['quantity'] == -1
+
+    def consume(self, pool_id, quantity=1):
+        """ Account successful bind (negative quantity for detach), refetch pool if quantity is unknown """
+        try:
+            quantity = int(quantity)
+        except (TypeError, ValueError):
+            # server picked the quantity
+            self.refresh_pool(pool_id)
+            return
+        with self.lock:
+            if pool_id in self.pools:
+                self.pools[pool_id]['consumed'] += quantity
+
+    def refetch_once(self, owners, productid):
+        """
+        Drop owners' pools if productid was not refetched in this run yet
+
+        Returns True if pools should be looked up again.
+        """
+        with self.lock:
+            if productid in self.refetched:
+                return False
+            self.refetched.add(productid)
+        for owner in owners:
+            self.invalidate(owner)
+        return True
+
+    def refresh_pool(self, pool_id):
+        """ Refetch one pool (e.g. after failed bind) """
+        with self.lock:
+            if not pool_id in self.pools:
+                return
+        pool = self.fetch_pool(pool_id)
+        if pool is None:
+            return
+        with self.lock:
+            if pool_id in self.pools:
+                self.pools[pool_id].update(pool)
+
+    def creates_derived(self, pool_id):
+        """ Check if binding to pool creates derived (guest) pools """
+        with self.lock:
+            pool = self.pools.get(pool_id, {})
+        for attr in pool.get('productAttributes', []):
+            if attr['name'] == 'virt_limit' and attr['value'] not in ['0', 0]:
+                return True
+        return False
+
+    def invalidate(self, owner=None):
+        """ Drop cached pools (for all owners if owner is None) """
+        with self.lock:
+            if owner is None:
+                self.owners.clear()
+                self.pools.clear()
+                self.index.clear()
+                self.refetched.clear()
+            elif owner in self.owners:
+                for pool in self.owners.pop(owner):
+                    self.pools.pop(pool['id'], None)
+                self.index.pop(owner, None)
+
+
 class SMPortal(BasePortal):
     """ SMPortal """
 
-    def __init__(self, api_url=None, candlepin_url=None, portal_url=None, login='admin', password='admin', maxtries=40, insecure=None, configfile=None, candlepin_port=443):
-        BasePortal.__init__(self, login, password, maxtries, insecure, api_url, portal_url, configfile)
+    def __init__(self, api_url=None, candlepin_url=None, portal_url=None, login='admin', password='admin', maxtries=40, insecure=None, configfile=None, candlepin_port=443,
+                 retry_policy=None):
+        BasePortal.__init__(self, login, password, maxtries, insecure, api_url, portal_url, configfile, retry_policy)
 
         self.candlepin_port = candlepin_port
 
@@ -42,53 +302,172 @@ class SMPortal(BasePortal):
         if self.candlepin_url:
             self.candlepin_url = self.candlepin_url.replace("https://", "")
 
+        try:
+            self.client_cache_size = self.config.getint('subman', 'client_cache_size')
+        except:
+            self.logger.debug("Failed to get 'subman/client_cache_size' setting from config file")
+            self.client_cache_size = 64
+
+        try:
+            self.cdn_chunk_size = self.config.getint('subman', 'cdn_chunk_size')
+        except:
+            self.logger.debug("Failed to get 'subman/cdn_chunk_size' setting from config file")
+            self.cdn_chunk_size = 1024 * 1024
+
+        try:
+            self.job_timeout = self.config.getint('subman', 'job_timeout')
+        except:
+            self.logger.debug("Failed to get 'subman/job_timeout' setting from config file")
+            self.job_timeout = 600
+
+        try:
+            self.page_size = self.config.getint('subman', 'page_size')
+        except:
+            self.logger.debug("Failed to get 'subman/page_size' setting from config file")
+            self.page_size = 500
+
+        try:
+            self.guest_batch = self.config.getint('subman', 'guest_batch')
+        except:
+            self.logger.debug("Failed to get 'subman/guest_batch' setting from config file")
+            self.guest_batch = 50
+
+        # uuid -> client connection, entitlement cert serial -> mTLS session
+        # cert material is attached to connections/sessions and is released
+        # when the last user drops them, not on eviction
+        self._client_cons = LRUCache(self.client_cache_size)
+        self._ent_sessions = LRUCache(self.client_cache_size * 4)
+        # entitlement cert serial -> content path patterns
+        self._ent_paths = LRUCache(self.client_cache_size * 4)
+
         self.con = connection.UEPConnection(self.candlepin_url, ssl_port=self.candlepin_port, username=self.login, password=self.password, insecure=self.insecure)
+        # older python-rhsm can't request entitlement certs in the list call
+        self.list_request_certs = 'request_certs' in inspect.getargspec(connection.UEPConnection.getEntitlementList)[0]
+        self.unbind_by_pool = hasattr(connection.UEPConnection, 'unbindByPoolId')
+        self.pool_cache = PoolCache(self._fetch_pools, self._fetch_pool)
+
+    def _collection_url(self, path):
+        """ Candlepin REST URL for path (relative to the API handler) """
+        return 'https://%s:%s%s%s' % (self.con.host, self.con.ssl_port, self.con.handler, path)
+
+    def _iter_collection(self, path, page_size=None, **params):
+        """
+        Iterate over Candlepin collection, 'page_size' items per request
 
-    def _get_subscriptions(self):
-        """ Get existing subsctiptions """
-        owners = self._retr(self.con.getOwnerList, lambda res: res is not None, 1, True, self.portal_login, self.login)
+        Items are yielded as pages arrive, so only one page is kept in
+        memory. Servers without paging support return everything at once.
+        """
+        if page_size is None:
+            page_size = self.page_size
+        url = self._collection_url(path)
+        page = 1
+        while True:
+            params.update({'page': page, 'per_page': page_size, 'sort_by': 'id', 'order': 'asc'})
+            req = self._retr(self.session.get, lambda res: res.status_code == 200, 1, True, self._heal_login, url, params=dict(params),
+                             auth=(self.con.username, self.con.password), verify=not self.insecure, timeout=self.timeout)
+            items = req.json()
+            for item in items:
+                yield item
+            if len(items) != page_size or not 'link' in req.headers:
+                # last page or paging is not supported
+                break
+            page += 1
+
+    def iter_pools(self, owner=None):
+        """ Iterate over owner pools (first owner if not set) """
+        if owner is None:
+            owner = self._get_owner_key()
+        return self._iter_collection('/owners/%s/pools' % owner)
+
+    def iter_consumers(self, owner=None):
+        """ Iterate over owner consumers (first owner if not set) """
+        if owner is None:
+            owner = self._get_owner_key()
+        return self._iter_collection('/owners/%s/consumers' % owner)
+
+    def _fetch_pools(self, owner):
+        """ Get all owner pools """
+        return self.iter_pools(owner)
+
+    def _fetch_pool(self, pool_id):
+        """ Get one pool """
+        return self._retr(self.con.getPool, lambda res: res is not None, 1, False, self._heal_login, pool_id)
+
+    def _get_subscriptions(self, owners=None):
+        """ Get existing subsctiptions (owners are queried in parallel) """
+        if owners is None:
+            owners = [own['key'] for own in self.get_owners()]
         self.logger.debug("Owners: %s" % owners)
-        subscriptions = []
-        for own in owners:
-            pools = self._retr(self.con.getPoolsList, lambda res: res is not None, 1, True, self.portal_login, owner=own['key'])
-            for pool in pools:
-                subscriptions.append(pool['subscriptionId'])
-            self.logger.debug("Subscriptions: %s" % subscriptions)
-        return set(subscriptions)
-
-    def check_subscriptions(self, uid_list, external_heal = None):
-        """ Check subscription status """
-        uid_set = set([str(uid) for uid in uid_list])
-        if not external_heal:
-            heal = self.portal_login
-        else:
-            heal = lambda: (external_heal(), self.portal_login())
-        sub_set = self._retr(self._get_subscriptions, lambda res: uid_set <= res, 30, False, heal)
-        if sub_set is not None:
-            return "<Response [200]>"
-        else:
-            self.logger.error("Can't find subscriptions")
-            return None
+        subscriptions = set()
+        fetch = lambda owner: set([pool['subscriptionId'] for pool in self.iter_pools(owner)])
+        for owner_subs, err in self._parallel(fetch, owners, self.pool_size):
+            if err is not None:
+                raise err
+            subscriptions.update(owner_subs)
+        self.logger.debug("Subscriptions: %s" % subscriptions)
+        return subscriptions
+
+    def check_subscriptions(self, uid_list, external_heal=None, timeout=None):
+        """
+        Check subscription status
+
+        Waits until all subscriptions appear in owners' pools, subscriptions
+        already seen are not waited for again. Polling starts with 5 second
+        intervals, slows down (up to 60 seconds) while nothing new shows up
+        and gives up after 'timeout' seconds (maxtries * 30 by default).
+        Portal login is redone after every round without progress.
+        """
+        pending = set([str(uid) for uid in uid_list])
+        if timeout is None:
+            timeout = self.maxtries * 30
+        started = time.time()
+        delay = 5
+        # pylint: disable=W0703
+        while True:
+            found = set()
+            try:
+                found = pending & self._get_subscriptions()
+            except Exception, err:
+                self.logger.debug("Failed to get subscriptions: %s", err)
+            pending -= found
+            if not pending:
+                return "<Response [200]>"
+            delay = 5 if found else min(delay * 1.5, 60)
+            if time.time() - started + delay > timeout:
+                break
+            self.logger.debug("Still waiting for subscriptions: %s, next check in %s seconds", ", ".join(sorted(pending)), delay)
+            if external_heal:
+                external_heal()
+            if not found:
+                # portal login makes freshly hocked subscriptions show up in candlepin
+                try:
+                    self._heal_login()
+                except Exception, err:
+                    self.logger.debug("Portal login failed: %s", err)
+            time.sleep(delay)
+        self.logger.error("Can't find subscriptions: %s", ", ".join(sorted(pending)))
+        return None
 
     def create_distributor(self, name, distributor_version='sam-1.3'):
         """ Create new SAM distributor on portal"""
-        distributor = self._retr(self.con.registerConsumer, lambda res: 'uuid' in res, 1, True, self.portal_login,
+        distributor = self._retr(self.con.registerConsumer, lambda res: 'uuid' in res, 1, True, self._heal_login,
                                  name=name, type={'id': '5', 'label': 'sam', 'manifest': True}, facts={'distributor_version': distributor_version})
         return distributor['uuid']
 
     def create_satellite(self, name, distributor_version='sat-5.6'):
         """ Create new Satellite5 distributor on portal"""
-        distributor = self._retr(self.con.registerConsumer, lambda res: 'uuid' in res, 1, True, self.portal_login,
+        distributor = self._retr(self.con.registerConsumer, lambda res: 'uuid' in res, 1, True, self._heal_login,
                                  name=name, type={'id': '9', 'label': 'satellite', 'manifest': True},
                                  facts={'distributor_version': distributor_version, 'system.certificate_version': '3.0'})
         return distributor['uuid']
 
     def distributor_available_subscriptions(self, uuid):
         """ Get available/attached subscriptions """
-        owners = self._retr(self.con.getOwnerList, lambda res: 'key' in res[0], 1, True, self.portal_login, self.login)
+        owners = self.get_owners(check=lambda res: 'key' in res[0])
         subscriptions = []
         for own in owners:
-            pools = self._retr(self.con.getPoolsList, lambda res: res is not None, 1, True, self.portal_login, owner=own['key'])
+            self.pool_cache.invalidate(own['key'])
+            pools = self.pool_cache.get(own['key'])
             for pool in pools:
                 if 'subscriptionSubKey' in pool and pool['subscriptionSubKey'] == 'derived':
                     # skip derived pools
@@ -112,7 +491,7 @@ class SMPortal(BasePortal):
     def distributor_attached_subscriptions(self, uuid):
         """ Get available/attached subscriptions """
         subscriptions = []
-        entitlements = self._retr(self.con.getEntitlementList, lambda res: res is not None, 1, True, self.portal_login, consumerId=uuid)
+        entitlements = self._retr(self.con.getEntitlementList, lambda res: res is not None, 1, True, self._heal_login, consumerId=uuid)
         for entitlement in entitlements:
             serials = []
             for cert in entitlement['certificates']:
@@ -124,15 +503,29 @@ class SMPortal(BasePortal):
                                   'date_start': pool['startDate'],
                                   'date_end': pool['endDate'],
                                   'subscriptionId': pool['subscriptionId'],
-                                  'serials': serials})
+                                  'serials': serials,
+                                  'entitlement_quantity': entitlement.get('quantity', 1)})
         return subscriptions
 
-    def distributor_attach_everything(self, uuid):
+    def distributor_attach_everything(self, uuid, workers=None):
         """ Attach all available subscriptions to distributor """
-        return self.distributor_attach_subscriptions(uuid, subscriptions=None)
+        return self.distributor_attach_subscriptions(uuid, subscriptions=None, workers=workers)
 
-    def distributor_attach_subscriptions(self, uuid, subscriptions=None):
-        """ Attach subscriptions to distributor """
+    @staticmethod
+    def _bulk_report(action, results):
+        """ Raise SMPortalException listing failed pools (if any) """
+        failed = ["%s (%s)" % (res['id'], res['error']) for res in results if res['status'] != 'ok']
+        if failed:
+            raise SMPortalException("Failed to %s: %s" % (action, ", ".join(failed)))
+
+    def distributor_attach_subscriptions(self, uuid, subscriptions=None, workers=None, report=False):
+        """
+        Attach subscriptions to distributor
+
+        Pools are bound in parallel (up to 'workers', pool_size by default).
+        With 'report' list of per-pool results is returned, otherwise
+        SMPortalException is raised if some pool failed.
+        """
         if subscriptions is None:
             subscriptions = self.distributor_available_subscriptions(uuid)
             for sub in subscriptions:
@@ -141,35 +534,154 @@ class SMPortal(BasePortal):
                     sub['quantity'] = 64
         if subscriptions is None or subscriptions == []:
             raise SMPortalException("Nothing to attach")
-        for sub in subscriptions:
-            self._retr(self.con.bindByEntitlementPool, lambda res: res is not None, 1, True, self.portal_login, uuid, sub['id'], sub['quantity'])
+        if workers is None:
+            workers = self.pool_size
+
+        def _bind(sub):
+            """ Bind one pool """
+            ents = self._retr(self.con.bindByEntitlementPool, lambda res: res is not None, 1, True, self._heal_login, uuid, sub['id'], sub['quantity'])
+            self.pool_cache.consume(sub['id'], sub['quantity'])
+            return [ent['id'] for ent in ents if 'id' in ent]
+
+        results = []
+        for sub, (ents, err) in zip(subscriptions, self._parallel(_bind, subscriptions, workers)):
+            results.append({'id': sub['id'],
+                            'quantity': sub['quantity'],
+                            'status': 'ok' if err is None else 'failed',
+                            'entitlements': ents,
+                            'error': None if err is None else str(err)})
+        if report:
+            return results
+        self._bulk_report('attach', results)
         return "<Response [200]>"
 
-    def distributor_detach_subscriptions(self, uuid, subscriptions=[]):
-        """ Detach subscriptions from distributor """
-        detach_serials = []
-        detach_subs = []
+    @staticmethod
+    def _succeeded(func):
+        """ Wrap call without meaningful result (e.g. DELETE) to return True, so _retr can tell success from exception """
+        def _call(*args, **kwargs):
+            """ Call func, True if it didn't raise """
+            func(*args, **kwargs)
+            return True
+        # same circuit breaker and metrics as the plain call
+        _call.__name__ = func.__name__
+        return _call
+
+    def _unbind_pool(self, uuid, pool_id, serials):
+        """ Remove pool from consumer: in one call if supported, serial by serial otherwise (raises on failure) """
+        # pylint: disable=W0703
+        if self.unbind_by_pool:
+            try:
+                self._retr(self._succeeded(self.con.unbindByPoolId), lambda res: res is True, 1, True, self._heal_login, uuid, pool_id,
+                           retry_policy=RetryPolicy.preset('fast', fatal_codes=(401, 403, 404, 405)))
+                return 'pool'
+            except Exception, err:
+                self.logger.debug("Unbind by pool %s failed (%s), unbinding by serial", pool_id, err)
+        for serial in serials:
+            self._retr(self._succeeded(self.con.unbindBySerial), lambda res: res is True, 1, True, self._heal_login, uuid, serial)
+        return 'serial'
+
+    def distributor_detach_subscriptions(self, uuid, subscriptions=[], workers=None, report=False):
+        """
+        Detach subscriptions from distributor
+
+        Pools are detached in parallel (up to 'workers', pool_size by
+        default). With 'report' list of per-pool results is returned,
+        otherwise SMPortalException is raised if some pool failed.
+        """
+        detach = OrderedDict()
+        released = {}
         attached_subs = self.distributor_attached_subscriptions(uuid)
         for sub in attached_subs:
             if sub['id'] in subscriptions:
                 # this sub should be detached
-                detach_serials += sub['serials']
-                detach_subs.append(sub['id'])
-        diff = list(set(subscriptions) - set(detach_subs))
+                detach.setdefault(sub['id'], []).extend(sub['serials'])
+                released[sub['id']] = released.get(sub['id'], 0) + sub['entitlement_quantity']
+        diff = list(set(subscriptions) - set(detach.keys()))
         if len(diff) != 0:
             raise SMPortalException("Can't detach subs: %s" % diff)
-        for serial in detach_serials:
-            self._retr(self.con.unbindBySerial, lambda res: True, 1, True, self.portal_login, uuid, serial)
+        if workers is None:
+            workers = self.pool_size
+        results = []
+        for pool_id, (method, err) in zip(detach.keys(), self._parallel(lambda pool_id: self._unbind_pool(uuid, pool_id, detach[pool_id]), detach.keys(), workers)):
+            if err is None:
+                self.pool_cache.consume(pool_id, -released[pool_id])
+            results.append({'id': pool_id,
+                            'serials': detach[pool_id],
+                            'status': 'ok' if err is None else 'failed',
+                            'method': method,
+                            'error': None if err is None else str(err)})
+        if report:
+            return results
+        self._bulk_report('detach', results)
         return "<Response [200]>"
 
-    def distributor_download_manifest(self, uuid):
-        """ Download manifest """
-        req = self._retr(requests.get, lambda res: res.status_code == 200, 1, True, self.portal_login,
-                         "https://%s%s/consumers/%s/export" % (self.con.host, self.con.handler, uuid), verify=False, auth=(self.login, self.password))
-        tfile = tempfile.NamedTemporaryFile(delete=False, suffix=".zip")
-        tfile.write(req.content)
-        tfile.close()
-        return tfile.name
+    def _stream_download(self, url, fname, state, **kwargs):
+        """
+        Stream url to fname in cdn_chunk_size chunks, resuming partial data
+
+        Resume (Range) is only attempted when the previous attempt got a
+        validator (ETag/Last-Modified), it is sent as If-Range so a
+        regenerated file is downloaded from scratch. 'state' keeps the
+        validator between attempts. Raises on incomplete body.
+        """
+        headers = dict(kwargs.pop('headers', {}))
+        offset = os.path.getsize(fname) if os.path.exists(fname) else 0
+        if offset > 0 and state.get('validator') is not None:
+            headers['Range'] = 'bytes=%d-' % offset
+            headers['If-Range'] = state['validator']
+        else:
+            offset = 0
+        res = self.session.get(url, stream=True, headers=headers, timeout=self.timeout, **kwargs)
+        if res.status_code == 416:
+            # our partial file is bigger than the (new?) data
+            res.close()
+            os.unlink(fname)
+            state['validator'] = None
+            raise SMPortalException("Range not satisfiable for %s, restarting download" % url)
+        if not res.status_code in [200, 206]:
+            res.close()
+            return res
+        if res.status_code == 200:
+            offset = 0
+            state['validator'] = res.headers.get('etag') or res.headers.get('last-modified')
+        length = res.headers.get('content-length')
+        size = offset
+        try:
+            with open(fname, 'ab' if offset else 'wb') as fd:
+                for chunk in res.iter_content(chunk_size=self.cdn_chunk_size):
+                    fd.write(chunk)
+                    size += len(chunk)
+        finally:
+            res.close()
+        if length is not None and res.headers.get('content-encoding') in [None, 'identity'] and size - offset != int(length):
+            raise SMPortalException("Short read for %s: got %s of %s bytes" % (url, size - offset, length))
+        self.logger.debug("Downloaded %s bytes of %s (resumed at %s)", size, url, offset)
+        return res
+
+    def distributor_download_manifest(self, uuid, target=None):
+        """
+        Download manifest
+
+        Export is streamed to 'target' (temporary .zip file if not set),
+        interrupted downloads are resumed when the server allows it.
+        Returns file name.
+        """
+        if target is None:
+            tfile = tempfile.NamedTemporaryFile(delete=False, suffix=".zip")
+            tfile.close()
+            target = tfile.name
+        part = target + '.part'
+        state = {}
+        try:
+            self._retr(self._stream_download, lambda res: res.status_code in [200, 206], 1, True, self._heal_login,
+                       self._collection_url("/consumers/%s/export" % uuid), part, state, verify=not self.insecure,
+                       auth=(self.login, self.password))
+        except:
+            if os.path.exists(part):
+                os.unlink(part)
+            raise
+        os.rename(part, target)
+        return target
 
     def _get_satellite_cert(self, uuid):
         session = self.portal_login()
@@ -179,7 +691,8 @@ class SMPortal(BasePortal):
 
     def satellite_download_cert(self, uuid):
         """ Download satellite cert """
-        req = self._retr(self._get_satellite_cert, lambda res: res.status_code == 200 and res.headers['content-type'] == 'application/octet-stream', 10, True, None, uuid)
+        req = self._retr(self._get_satellite_cert, lambda res: res.status_code == 200 and res.headers['content-type'] == 'application/octet-stream', 10, True,
+                         self._heal_login, uuid)
         tfile = tempfile.NamedTemporaryFile(delete=False, suffix=".xml")
         tfile.write(req.content)
         tfile.close()
@@ -187,7 +700,8 @@ class SMPortal(BasePortal):
 
     def unregister_consumer(self, uuid):
         """ Unregister consumer """
-        return self._retr(self.con.unregisterConsumer, lambda res: True, 1, True, self.portal_login, uuid)
+        self._client_cons.pop(uuid)
+        return self._retr(self.con.unregisterConsumer, lambda res: True, 1, True, self._heal_login, uuid)
 
     def delete_distributor(self, uuid):
         """ Delete distributor """
@@ -202,7 +716,7 @@ class SMPortal(BasePortal):
         if sys_name is None:
             sys_name = 'TestHypervisor' + ''.join(random.choice('0123456789ABCDEF') for i in range(6))
 
-        sys = self._retr(self.con.registerConsumer, lambda res: res is not None, 1, True, self.portal_login,
+        sys = self._retr(self.con.registerConsumer, lambda res: res is not None, 1, True, self._heal_login,
                          name=sys_name, type={'id': '6', 'label': 'hypervisor', 'manifest': True}, facts={}, owner=org)
         self.logger.info("Hypervisor %s created with uid %s" % (sys_name, sys['uuid']))
         return (sys_name, sys['uuid'])
@@ -231,7 +745,7 @@ class SMPortal(BasePortal):
         facts['system.certificate_version'] = '3.2'
         facts['distribution.name'], facts['distribution.version'] = (dist_name, dist_version)
 
-        sys = self._retr(self.con.registerConsumer, lambda res: res is not None, 1, True, self.portal_login,
+        sys = self._retr(self.con.registerConsumer, lambda res: res is not None, 1, True, self._heal_login,
                          name=sys_name, facts=facts, installed_products=installed_products, owner=org)
 
         self.logger.info("Sys %s created with uid %s" % (sys_name, sys['uuid']))
@@ -244,34 +758,129 @@ class SMPortal(BasePortal):
 
         return (sys_name, sys['uuid'])
 
-    @staticmethod
-    def _get_suitable_pools(pools, productid, is_virtual):
-        """ Get suitable pools """
-        pool_ids = []
-        for pool in pools:
-            if pool['productId'] == productid and (pool['consumed'] < pool['quantity'] or pool['quantity'] == -1):
-                if is_virtual in [True, 'true', 'True'] and pool['subscriptionSubKey'] != 'master':
-                    pool_ids.insert(0, pool['id'])
-                elif pool['subscriptionSubKey'] == 'master':
-                    pool_ids.append(pool['id'])
-                else:
-                    # skip derived pools for non-virtual systems
-                    pass
-        return pool_ids
-
     def subscribe_system(self, uuid, pool_id=None, blow_up=True):
         """ Subscribe system to a given pool or select it automatically """
         con_client = self.establish_client_con(uuid)
         assert con_client is not None
         if pool_id is None:
-            entitlements = self._retr(con_client.bind, lambda res: res is not None, 1, blow_up, self.portal_login, uuid)
+            entitlements = self._retr(con_client.bind, lambda res: res is not None, 1, blow_up, self._heal_login, uuid)
         else:
-            entitlements = self._retr(con_client.bindByEntitlementPool, lambda res: res is not None, 1, blow_up, self.portal_login, uuid, pool_id)
+            entitlements = self._retr(con_client.bindByEntitlementPool, lambda res: res is not None, 1, blow_up, self._heal_login, uuid, pool_id)
         self.logger.debug("Got %s after binding" % entitlements)
         return entitlements
 
+    def _existing_entitlements(self, uuid):
+        """ Get (productId, serial) pairs for consumer entitlements """
+        return [(ent['pool']['productId'], ent['certificates'][0]['serial']['serial'])
+                for ent in self._retr(self.con.getEntitlementList, lambda res: res is not None, 1, True, self._heal_login, uuid)]
+
+    def _guest_host(self, uuid):
+        """ Get host consumer uuid for guest (None if unknown) """
+        # pylint: disable=W0703
+        try:
+            host = self.con.conn.request_get('/consumers/%s/host' % uuid)
+        except Exception, err:
+            self.logger.debug("Failed to get host for %s: %s", uuid, err)
+            return None
+        if not host:
+            return None
+        return host.get('uuid')
+
+    @staticmethod
+    def _is_quantity_failure(err):
+        """ Check if bind failed because pool has no free entitlements """
+        if err is None:
+            return False
+        message = str(getattr(err, 'msg', err)).lower()
+        return 'no subscriptions are available' in message or 'quantity' in message
+
+    def _attach_subscriptions(self, sys, system_subs, owners, org=None, update=False, entitlements=None):
+        """
+        Attach subscriptions to one system (and remove others when updating)
+
+        'entitlements' are prefetched _existing_entitlements() for 'update'.
+        Guests may have 'host_uuid' set, it is looked up otherwise.
+        """
+        # don't hammer sick backend, wait for circuit breakers to allow probing
+        # pools are listed with session.get (see _iter_collection)
+        self._breaker_pause(self._breaker_key(self.session.get, [self._collection_url('/pools')]))
+        self._breaker_pause('bindByEntitlementPool')
+        # trying next suitable pool is better than waiting for the current one
+        bind_policy = RetryPolicy.preset('fast', maxtries=2)
+        existing_subs = []
+        if update:
+            if entitlements is None:
+                entitlements = self._existing_entitlements(sys['uuid'])
+            existing_subs = [product_id for product_id, _ in entitlements]
+
+        processed_subs = []
+
+        if org is not None:
+            # we need to bind as customer
+            con_client = self.establish_client_con(sys['uuid'])
+        else:
+            con_client = self.con
+
+        is_virtual = sys['facts']['virt.is_guest']
+        host_uuid = sys.get('host_uuid')
+        if host_uuid is None and is_virtual in [True, 'true', 'True'] and system_subs != []:
+            # derived pools of the host are only suitable for its guests
+            host_uuid = self._guest_host(sys['uuid'])
+
+        bind_errors = []
+
+        def _bind(uuid, pool_id):
+            """ Bind keeping the last error for the caller """
+            try:
+                return con_client.bindByEntitlementPool(uuid, pool_id)
+            except Exception, err:
+                bind_errors.append(err)
+                raise
+        # same circuit breaker and metrics as the plain call
+        _bind.__name__ = 'bindByEntitlementPool'
+
+        for sub in system_subs:
+            processed_subs.append(sub['productId'])
+            if not sub['productId'] in existing_subs:
+                # we need to attach sub
+                pool_ids = self.pool_cache.suitable_pools(owners, sub['productId'], is_virtual, host_uuid)
+                if pool_ids == [] and self.pool_cache.refetch_once(owners, sub['productId']):
+                    # cached pools may be outdated (e.g. new derived pools)
+                    pool_ids = self.pool_cache.suitable_pools(owners, sub['productId'], is_virtual, host_uuid)
+                attached = None
+                for pool_id in pool_ids:
+                    del bind_errors[:]
+                    req = self._retr(_bind, lambda res: res is not None, 1, False, None, sys['uuid'], pool_id,
+                                     retry_policy=bind_policy)
+                    if req is not None:
+                        attached = pool_id
+                        self.pool_cache.consume(pool_id)
+                        if self.pool_cache.creates_derived(pool_id):
+                            # guest pools will appear, refetch pools on next use
+                            for own in owners:
+                                self.pool_cache.invalidate(own)
+                        break
+                    if self._is_quantity_failure(bind_errors[-1] if bind_errors != [] else None):
+                        # other systems may still fit rules of this pool, only its counts are stale
+                        self.pool_cache.refresh_pool(pool_id)
+                if attached is not None:
+                    self.logger.info('Successfully subscribed system %s:%s to pool %s' % (sys['name'], sys['uuid'], attached))
+                else:
+                    self.logger.error('Failed to find appropriate pool for system %s:%s' % (sys['name'], sys['uuid']))
+        if update:
+            # new entitlements are all in processed_subs, only old ones may need removal
+            for product_id, serial in entitlements:
+                if not product_id in processed_subs:
+                    # unbinding everything else
+                    self._retr(con_client.unbindBySerial, lambda res: res is not None, 1, True, self._heal_login, sys['uuid'], serial)
+
     def subscribe_systems(self, systems=None, csv_file=None, org=None, update=False):
-        """ Subscribe systems """
+        """
+        Subscribe systems
+
+        Missing consumer facts and existing entitlements (for 'update') are
+        fetched in parallel (up to pool_size requests) before binding.
+        """
         if systems is None and csv_file is None:
             self.logger.error('Neither csv_file nor systems were specified!')
             return None
@@ -283,54 +892,44 @@ class SMPortal(BasePortal):
         if systems is not None:
             all_systems = systems[::]
         else:
-            all_systems = []
-            for consumer in self._retr(self.con.getConsumers, lambda res: res is not None, 1, True, self.portal_login, owner=org):
-                # put physical systems in front
-                if not 'facts' in consumer:
-                    # need to fetch additional data
-                    consumer = self._retr(self.con.getConsumer, lambda res: res is not None, 1, True, self.portal_login, consumer['uuid'])
-
-                if consumer['facts']['virt.is_guest'] in [True, 'true', 'True']:
-                    all_systems.append(consumer)
+            consumers = []
+            missing = []
+            for consumer in self.iter_consumers(org):
+                if 'facts' in consumer:
+                    consumers.append(consumer)
                 else:
-                    all_systems.insert(0, consumer)
+                    # need to fetch additional data
+                    missing.append(consumer['uuid'])
+            fetch = lambda uuid: self._retr(self.con.getConsumer, lambda res: res is not None, 1, True, self._heal_login, uuid)
+            for consumer, err in self._parallel(fetch, missing, self.pool_size):
+                if err is not None:
+                    raise err
+                consumers.append(consumer)
+            # put physical systems in front
+            all_systems = [consumer for consumer in consumers if not consumer['facts']['virt.is_guest'] in [True, 'true', 'True']] + \
+                          [consumer for consumer in consumers if consumer['facts']['virt.is_guest'] in [True, 'true', 'True']]
 
         if org is None:
             owners = [self._get_owner_key()]
         else:
             owners = [org]
         self.logger.debug("Owners: %s" % owners)
+        self.pool_cache.invalidate()
 
         ext_subs = {}
 
         if systems is None:
-            data = csv.DictReader(open(csv_file))
-            for row in data:
-                num = 0
-                total = int(row['Count'])
-                subscriptions = []
-                if row['Subscriptions']:
-                    for sub in row['Subscriptions'].split(';'):
-                        [sub_id, sub_name] = sub.split('|')
-                        subscriptions.append({'productId': sub_id, 'productName': sub_name})
-                while num < total:
-                    num += 1
-                    name = self._namify(row['Name'], num)
-                    ext_subs[name] = subscriptions
+            for _, name, subscriptions in self._expand_csv(csv_file, ['Subscriptions'], self._parse_subscriptions):
+                ext_subs[name] = subscriptions
 
-        for sys in all_systems:
-            pools = []
-            for own in owners:
-                own_pools = self._retr(self.con.getPoolsList, lambda res: res is not None, 1, True, self.portal_login, sys['uuid'], owner=own)
-                pools += own_pools
-
-            existing_subs = []
-            if update:
-                for ent in self._retr(self.con.getEntitlementList, lambda res: res is not None, 1, True, self.portal_login, sys['uuid']):
-                    existing_subs.append(ent['pool']['productId'])
-
-            processed_subs = []
+        entitlements = {}
+        if update:
+            for sys, (ents, err) in zip(all_systems, self._parallel(lambda sys: self._existing_entitlements(sys['uuid']), all_systems, self.pool_size)):
+                if err is not None:
+                    raise err
+                entitlements[sys['uuid']] = ents
 
+        for sys in all_systems:
             if systems is None:
                 if sys['name'] in ext_subs:
                     system_subs = ext_subs[sys['name']]
@@ -339,154 +938,252 @@ class SMPortal(BasePortal):
                     system_subs = []
             else:
                 system_subs = sys['subscriptions']
-
-            if org is not None:
-                # we need to bind as customer
-                con_client = self.establish_client_con(sys['uuid'])
-            else:
-                con_client = self.con
-
-            for sub in system_subs:
-                processed_subs.append(sub['productId'])
-                if not sub['productId'] in existing_subs:
-                    # we need to attach sub
-                    pool_ids = self._get_suitable_pools(pools, sub['productId'], sys['facts']['virt.is_guest'])
-                    attached = None
-                    for pool_id in pool_ids:
-                        maxtries_old = self.maxtries
-                        self.maxtries = 2
-                        req = self._retr(con_client.bindByEntitlementPool, lambda res: res is not None, 1, False, None, sys['uuid'], pool_id)
-                        self.maxtries = maxtries_old
-                        if req is not None:
-                            attached = pool_id
-                            break
-                    if attached is not None:
-                        self.logger.info('Successfully subscribed system %s:%s to pool %s' % (sys['name'], sys['uuid'], attached))
-                    else:
-                        self.logger.error('Failed to find appropriate pool for system %s:%s' % (sys['name'], sys['uuid']))
-            if update:
-                for ent in self._retr(con_client.getEntitlementList, lambda res: res is not None, 1, True, self.portal_login, sys['uuid']):
-                    if not ent['pool']['productId'] in processed_subs:
-                        # unbinding everything else
-                        serial = ent['certificates'][0]['serial']['serial']
-                        req = self._retr(con_client.unbindBySerial, lambda res: res is not None, 1, True, self.portal_login, sys['uuid'], serial)
-            if con_client.cert_file is not None:
-                os.unlink(con_client.cert_file)
-            if con_client.key_file is not None:
-                os.unlink(con_client.key_file)
+            self._attach_subscriptions(sys, system_subs, owners, org, update, entitlements.get(sys['uuid']))
         return "<Response [200]>"
 
-    def create_systems(self, csv_file, entitlement_dir=None, org=None, subscribe=True, update=False):
+    @staticmethod
+    def _parse_subscriptions(row):
+        """ Parse 'Subscriptions' CSV column """
+        subscriptions = []
+        if row['Subscriptions']:
+            for sub in row['Subscriptions'].split(';'):
+                [sub_id, sub_name] = sub.split('|')
+                subscriptions.append({'productId': sub_id, 'productName': sub_name})
+        return subscriptions
+
+    @classmethod
+    def _parse_system_row(cls, row):
+        """ Parse systems CSV row """
+        try:
+            cores = int(row['Cores'])
+        except ValueError:
+            cores = None
+        try:
+            sockets = int(row['Sockets'])
+        except ValueError:
+            sockets = None
+        try:
+            memory = int(row['RAM'])
+        except ValueError:
+            memory = None
+        arch = row['Arch']
+        if row['OS'].find(' ') != -1:
+            dist_name, dist_version = row['OS'].split(' ')
+        else:
+            dist_name, dist_version = ('RHEL', row['OS'])
+        consumer_type = 'System'
+        if 'Type' in row:
+            consumer_type = row['Type']
+
+        installed_products = []
+        if row['Products']:
+            for product in row['Products'].split(';'):
+                [product_number, product_name] = product.split('|')
+                installed_products.append({'productId': int(product_number), 'productName': product_name})
+
+        return {'cores': cores, 'sockets': sockets, 'memory': memory, 'arch': arch,
+                'dist_name': dist_name, 'dist_version': dist_version, 'consumer_type': consumer_type,
+                'installed_products': installed_products, 'subscriptions': cls._parse_subscriptions(row),
+                'is_guest': row['Virtual'] in ['Yes', 'Y', 'y'], 'host': row['Host']}
+
+    def create_systems(self, csv_file, entitlement_dir=None, org=None, subscribe=True, update=False, workers=1):
         """
         Register a bunch of systems from CSV file
 
+        Registration, host/guest allocation and subscription run as a
+        pipeline: systems without host are subscribed as soon as they are
+        registered. Guests of registered hosts are allocated in batches of
+        'guest_batch' with one host/guest allocation update per batch and
+        then subscribed, the rest is allocated when registration is over.
+        Up to 'workers' systems are registered concurrently, later stages
+        see systems in CSV order.
+
         # CSV: Name,Count,Org Label,Environment Label,Groups,Virtual,Host,OS,Arch,Sockets,RAM,Cores,SLA,Products,Subscriptions
         """
-        all_systems = []
-        host_systems = {}
-
-        data = csv.DictReader(open(csv_file))
-        for row in data:
-            if row['Name'].startswith('#'):
-                self.logger.debug("Skipping %s" % row['Name'])
-                continue
-            num = 0
-            total = int(row['Count'])
-            try:
-                cores = int(row['Cores'])
-            except ValueError:
-                cores = None
-            try:
-                sockets = int(row['Sockets'])
-            except ValueError:
-                sockets = None
-            try:
-                memory = int(row['RAM'])
-            except ValueError:
-                memory = None
-            arch = row['Arch']
-            if row['OS'].find(' ') != -1:
-                dist_name, dist_version = row['OS'].split(' ')
+        registered = {}
+        # name -> uuid for registered systems
+        by_name = {}
+        # host name -> guests waiting for host/guest allocation
+        host_guests = OrderedDict()
+        # hosts which already got some guests allocated
+        allocated = set()
+        # registration results waiting for their turn (in CSV order)
+        reorder = {}
+        next_idx = [0]
+        failed = []
+        owners = [org] if org is not None else [self._get_owner_key()]
+
+        def _register(item):
+            """ Registration stage """
+            idx, num, name, params = item
+            is_guest = params['is_guest']
+            if is_guest:
+                virt_uuid = name
             else:
-                dist_name, dist_version = ('RHEL', row['OS'])
-            consumer_type = 'System'
-            if 'Type' in row:
-                consumer_type = row['Type']
-
-            installed_products = []
-            if row['Products']:
-                for product in row['Products'].split(';'):
-                    [product_number, product_name] = product.split('|')
-                    installed_products.append({'productId': int(product_number), 'productName': product_name})
-
-            subscriptions = []
-            if row['Subscriptions']:
-                for sub in row['Subscriptions'].split(';'):
-                    [sub_id, sub_name] = sub.split('|')
-                    subscriptions.append({'productId': sub_id, 'productName': sub_name})
-
-            while num < total:
-                num += 1
-                name = self._namify(row['Name'], num)
-                if row['Virtual'] in ['Yes', 'Y', 'y']:
-                    is_guest = True
-                    virt_uuid = name
-                else:
-                    is_guest = False
-                    virt_uuid = ''
-
-                ntry = 0
-                while ntry < self.maxtries:
-                    try:
-                        if consumer_type in ['system', 'System']:
-                            (sys_name, sys_uid) = self.register_system(org, name, cores, sockets, memory, arch, dist_name,
-                                                                        dist_version, installed_products, is_guest, virt_uuid, entitlement_dir)
-                        elif consumer_type in ['hypervisor', 'Hypervisor']:
-                            (sys_name, sys_uid) = self.register_hypervisor(org, name)
-                        else:
-                            self.logger.error("Unknown consumer type %s for %s" % (consumer_type, name))
-                        break
-                    except:
-                        time.sleep(1)
-                        ntry += 1
-
-                all_systems.append({'name': sys_name, 'uuid': sys_uid, 'subscriptions': subscriptions, 'facts': {'virt.is_guest': is_guest}})
-
-                if row['Host'] is not None and row['Host'] != '':
-                    host_name = self._namify(row['Host'], num)
-                    if not host_name in host_systems:
-                        for sys in all_systems:
-                            if sys['name'] == host_name:
-                                host_systems[host_name] = [sys['uuid']]
-                    if host_name in host_systems:
-                        host_systems[host_name].append(name)
-
-        self.logger.debug("Host/guest allocation: %s" % host_systems)
-
-        for host in host_systems:
-            # setting host/guest allocation
-            host_detail = host_systems[host]
-            if len(host_detail) > 1:
-                self.set_hostguest_allocation(host_detail[0], host_detail[1::])
-
+                virt_uuid = ''
+
+            ntry = 0
+            sys_uid = None
+            while ntry < self.maxtries:
+                self._breaker_pause('registerConsumer')
+                try:
+                    if params['consumer_type'] in ['system', 'System']:
+                        (sys_name, sys_uid) = self.register_system(owners[0], name, params['cores'], params['sockets'], params['memory'], params['arch'],
+                                                                    params['dist_name'], params['dist_version'], params['installed_products'],
+                                                                    is_guest, virt_uuid, entitlement_dir)
+                    elif params['consumer_type'] in ['hypervisor', 'Hypervisor']:
+                        (sys_name, sys_uid) = self.register_hypervisor(owners[0], name)
+                    else:
+                        self.logger.error("Unknown consumer type %s for %s" % (params['consumer_type'], name))
+                    break
+                except:
+                    time.sleep(1)
+                    ntry += 1
+            if sys_uid is None:
+                self.logger.error("Failed to register %s" % name)
+                failed.append(name)
+                # still pass it to keep CSV order in the next stage
+                return [(idx, None, None)]
+
+            system = {'name': sys_name, 'uuid': sys_uid, 'subscriptions': params['subscriptions'], 'facts': {'virt.is_guest': is_guest}}
+            registered[idx] = system
+            host_name = None
+            if params['host'] is not None and params['host'] != '':
+                host_name = self._namify(params['host'], num)
+            return [(idx, system, host_name)]
+
+        def _allocate(host_name):
+            """ Set host/guest allocation for pending guests of the host and return them """
+            guests = host_guests.pop(host_name, [])
+            guest_names = [guest['name'] for guest in guests]
+            # pylint: disable=W0703
+            if not host_name in by_name:
+                self.logger.error("Host %s not found for %s" % (host_name, guest_names))
+            else:
+                self.logger.debug("Host/guest allocation for %s: %s" % (host_name, guest_names))
+                try:
+                    # later batches add to the guests allocated so far
+                    self.set_hostguest_allocation(by_name[host_name], guest_names, update=host_name in allocated)
+                    allocated.add(host_name)
+                    for guest in guests:
+                        guest['host_uuid'] = by_name[host_name]
+                except Exception, err:
+                    self.logger.error("Failed to set host/guest allocation for %s: %s" % (host_name, err))
+                    failed.append(host_name)
+            # guests are subscribed anyway
+            return guests
+
+        def _set_host(item):
+            """ Host/guest allocation stage: pass systems without host, allocate guests in batches """
+            reorder[item[0]] = item
+            out = []
+            while next_idx[0] in reorder:
+                _, system, host_name = reorder.pop(next_idx[0])
+                next_idx[0] += 1
+                if system is None:
+                    continue
+                by_name[system['name']] = system['uuid']
+                if host_name is None:
+                    out.append(system)
+                    continue
+                host_guests.setdefault(host_name, []).append(system)
+                if host_name in by_name and len(host_guests[host_name]) >= self.guest_batch:
+                    out += _allocate(host_name)
+            return out
+
+        def _allocate_guests():
+            """ Set host/guest allocation for guests left after registration """
+            out = []
+            for host_name in host_guests.keys():
+                out += _allocate(host_name)
+            return out
+
+        self.pool_cache.invalidate()
+
+        def _subscribe(system):
+            """ Subscription stage """
+            self._attach_subscriptions(system, system['subscriptions'], owners, org, update)
+
+        columns = ['Virtual', 'Host', 'OS', 'Arch', 'Sockets', 'RAM', 'Cores', 'Products', 'Subscriptions']
+        items = ((idx, num, name, params) for idx, (num, name, params) in enumerate(self._expand_csv(csv_file, columns, self._parse_system_row)))
+        stages = [(_register, workers), (_set_host, 1, _allocate_guests)]
+        if subscribe:
+            stages.append((_subscribe, 1))
+        errors = self._pipeline(items, stages, queue_size=max(100, workers * 2))
+        for item, err in errors:
+            self.logger.error("Failed to process %s: %s" % (item, err))
+        if errors != [] or failed != []:
+            raise SMPortalException("Failed to create %s systems from %s" % (len(errors) + len(failed), csv_file))
+
+        all_systems = [registered[idx] for idx in sorted(registered)]
         if subscribe:
-            return self.subscribe_systems(systems=all_systems, csv_file=None, org=org, update=update)
+            return "<Response [200]>"
         return all_systems
 
     def set_hostguest_allocation(self, host_uuid, guest_uuids, update=False):
         """ Set host/guest allocation """
         if update:
-            existing_guests = self._retr(self.con.getConsumer, lambda res: res is not None, 1, True, self.portal_login, host_uuid)['guestIds']
+            existing_guests = self._retr(self.con.getConsumer, lambda res: res is not None, 1, True, self._heal_login, host_uuid)['guestIds']
             self.logger.debug("Existing guests attached to %s: %s", host_uuid, existing_guests)
         else:
             existing_guests = []
         self.logger.debug("Setting host/guest allocation for %s, VMs: %s", host_uuid, existing_guests + guest_uuids)
-        return self._retr(self.con.updateConsumer, lambda res: True, 1, True, self.portal_login, host_uuid, guest_uuids=existing_guests + guest_uuids)
+        return self._retr(self.con.updateConsumer, lambda res: True, 1, True, self._heal_login, host_uuid, guest_uuids=existing_guests + guest_uuids)
+
+    JOB_DONE_STATES = ['FINISHED', 'FAILED', 'CANCELED', 'ABORTED']
+
+    def wait_for_job(self, job, timeout=None):
+        """
+        Poll async job until it is done
+
+        'job' is job status (as returned with 202) or job id. Polling backs
+        off up to 30 seconds between checks and gives up after 'timeout'
+        seconds (job_timeout by default). Returns final job status or None.
+        """
+        if isinstance(job, basestring):
+            job = {'id': job}
+        path = job.get('statusPath') or '/jobs/%s' % job['id']
+        if path.startswith(self.con.handler):
+            path = path[len(self.con.handler):]
+        if timeout is None:
+            timeout = self.job_timeout
+        # polling is limited by the deadline only
+        policy = RetryPolicy(maxtries=int(timeout) + 1, factor=1, multiplier=1.5, max_sleep=30, jitter=0.2, deadline=timeout)
+        req = self._retr(self.session.get, lambda res: res.status_code == 200 and res.json()['state'] in self.JOB_DONE_STATES, 2, False, None,
+                         self._collection_url(path), auth=(self.con.username, self.con.password), verify=not self.insecure, timeout=self.timeout,
+                         retry_policy=policy)
+        if req is None:
+            self.logger.error("Job %s didn't finish in %s seconds", job['id'], timeout)
+            return None
+        status = req.json()
+        if status['state'] != 'FINISHED':
+            self.logger.error("Job %s ended in %s state: %s", job['id'], status['state'], status.get('result'))
+        return status
+
+    def _heal_owner(self, owner, wait=False, timeout=None):
+        """ Heal one owner, optionally waiting for the job """
+        url = self._collection_url('/owners/%s/entitlements' % owner)
+        req = self._retr(self.session.post, lambda res: res.status_code == 202, 1, True, self._heal_login, url,
+                         auth=(self.con.username, self.con.password), verify=not self.insecure, timeout=self.timeout)
+        if not wait:
+            return req
+        status = self.wait_for_job(req.json(), timeout)
+        if status is None or status['state'] != 'FINISHED':
+            return None
+        return status
+
+    def heal_entire_org(self, owner=None, wait=False, timeout=None, workers=None):
+        """
+        Heal Entire Org
 
-    def heal_entire_org(self, owner=None, wait=False, timeout=None):
-        """ Heal Entire Org """
+        'owner' is owner key or list of keys (first owner if not set), lists
+        are healed concurrently (up to 'workers', pool_size by default) and
+        list of results is returned. Without 'wait' the result is 202
+        response, with 'wait' it is the finished job status (None if the
+        job failed or didn't finish in 'timeout' seconds).
+        """
         if owner is None:
-            owner_list = self._retr(self.con.getOwnerList, lambda res: res is not None, 1, True, self.portal_login, self.con.username)
+            owner_list = self.get_owners()
             if owner_list is None or owner_list == []:
                 self.logger.error('Failed to get owner list')
                 return None
@@ -494,19 +1191,20 @@ class SMPortal(BasePortal):
                 if len(owner_list) > 1:
                     self.logger.info('There are multiple owners available, will heal the first one: %s' % owner_list[0]['key'])
                 owner = owner_list[0]['key']
-        url = 'https://%s%s/owners/%s/entitlements' % (self.con.host, self.con.handler, owner)
-        req = self._retr(requests.post, lambda res: res.status_code == 202, 1, True, self.portal_login, url,
-                         auth=(self.con.username, self.con.password), verify=False)
-        if not wait:
-            return req
-        else:
-            # tmp
-            return req
+        if isinstance(owner, basestring):
+            return self._heal_owner(owner, wait, timeout)
+        if workers is None:
+            workers = self.pool_size
+        results = self._parallel(lambda key: self._heal_owner(key, wait, timeout), owner, workers)
+        for key, (_, err) in zip(owner, results):
+            if err is not None:
+                self.logger.error("Failed to heal %s: %s", key, err)
+        return [res for res, _ in results]
 
     def get_pools(self, owner=None):
-        """ Get pools """
+        """ Get pools (fresh data, also resets PoolCache for owner) """
         if owner is None:
-            owner_list = self._retr(self.con.getOwnerList, lambda res: res is not None, 1, True, self.portal_login, self.con.username)
+            owner_list = self.get_owners()
             if owner_list is None or owner_list == []:
                 self.logger.error('Failed to get owner list')
                 return None
@@ -514,35 +1212,55 @@ class SMPortal(BasePortal):
                 if len(owner_list) > 1:
                     self.logger.info('There are multiple owners available, will heal the first one: %s' % owner_list[0]['key'])
                 owner = owner_list[0]['key']
-        return self._retr(self.con.getPoolsList, lambda res: res is not None, 1, True, self.portal_login, owner=owner)
+        self.pool_cache.invalidate(owner)
+        return self.pool_cache.get(owner)
+
+    def _get_entitlements(self, con, uuid):
+        """
+        Get entitlements with certs using connection 'con'
+
+        Without request_certs support every entitlement is fetched
+        separately, these calls are done in parallel (up to pool_size).
+        """
+        if self.list_request_certs:
+            return self._retr(con.getEntitlementList, lambda res: res is not None, 1, True, self._heal_login, uuid, request_certs=True)
+        entitlements_list = self._retr(con.getEntitlementList, lambda res: res is not None, 1, True, self._heal_login, uuid)
+        results = self._parallel(lambda ent: self._retr(con.getEntitlement, lambda res: res is not None, 1, True, self._heal_login, ent['id']),
+                                 entitlements_list, min(self.pool_size, len(entitlements_list)))
+        for _, err in results:
+            if err is not None:
+                raise err
+        return [res for res, _ in results]
 
     def get_entitlements(self, uuid):
         """ Get entitlements (with certs)"""
-        if 'request_certs' in inspect.getargspec(self.con.getEntitlementList)[0]:
-            entitlements_list = self._retr(self.con.getEntitlementList, lambda res: res is not None, 1, True, self.portal_login, uuid, request_certs=True)
-            return entitlements_list
-        else:
-            entitlements_list = self._retr(self.con.getEntitlementList, lambda res: res is not None, 1, True, self.portal_login, uuid)
-            return [self._retr(self.con.getEntitlement, lambda res: res is not None, 1, True, self.portal_login, x['id']) for x in entitlements_list]
+        return self._get_entitlements(self.con, uuid)
 
     def get_entitlement_list(self, uuid):
         """ Get entitlements """
-        return self._retr(self.con.getEntitlementList, lambda res: res is not None, 1, True, self.portal_login, uuid)
-
-    def get_owners(self):
-        """ Get owners """
-        return self._retr(self.con.getOwnerList, lambda res: res is not None, 1, True, self.portal_login, self.con.username)
+        return self._retr(self.con.getEntitlementList, lambda res: res is not None, 1, True, self._heal_login, uuid)
+
+    def get_owners(self, check=lambda res: res is not None):
+        """ Get owners (cached) """
+        owners = self._cache_get('owners')
+        if owners is not None and check(owners):
+            return owners
+        owners = self._retr(self.con.getOwnerList, check, 1, True, self._heal_login, self.con.username)
+        if owners:
+            # empty list means owner is not created yet, don't cache it
+            self._cache_set('owners', owners)
+        return owners
 
     def _get_owner_key(self):
         """ Get first owner key """
-        owners = self._retr(self.con.getOwnerList, lambda res: res is not None and res != [] and 'key' in res[0], 1, True, self.portal_login, self.con.username)
+        owners = self.get_owners(check=lambda res: res is not None and res != [] and 'key' in res[0])
         self.logger.debug("Owners: %s" % owners)
         return owners[0]['key']
 
     def get_owner_info(self, owner=None):
         """ Get owner info """
         if owner is None:
-            owner_list = self._retr(self.con.getOwnerList, lambda res: res is not None, 1, True, self.portal_login, self.con.username)
+            owner_list = self.get_owners()
             if owner_list is None or owner_list == []:
                 self.logger.error('Failed to get owner list')
                 return None
@@ -550,75 +1268,247 @@ class SMPortal(BasePortal):
                 if len(owner_list) > 1:
                     self.logger.info('There are multiple owners available, will heal the first one: %s' % owner_list[0]['key'])
                 owner = owner_list[0]['key']
-        return self._retr(self.con.getOwnerInfo, lambda res: res is not None, 1, True, self.portal_login, owner)
+        return self._retr(self.con.getOwnerInfo, lambda res: res is not None, 1, True, self._heal_login, owner)
 
     def checkin_consumer(self, uuid):
         """ Checkin consumer """
-        return self._retr(self.con.checkin, lambda res: res is not None, 1, True, self.portal_login, uuid)
+        return self._retr(self.con.checkin, lambda res: res is not None, 1, True, self._heal_login, uuid)
 
     def update_consumer(self, uuid):
         """ Update consumer """
-        return self._retr(self.con.updateConsumer, lambda res: True, 1, True, self.portal_login, uuid)
+        return self._retr(self.con.updateConsumer, lambda res: True, 1, True, self._heal_login, uuid)
+
+    def close_client_cons(self):
+        """ Drop all cached client connections and credentials """
+        self._client_cons.clear()
+        self._ent_sessions.clear()
 
     def establish_client_con(self, uuid):
-        """ Connect with client cert """
+        """
+        Connect with client cert
+
+        Connections are kept in LRU cache (client_cache_size entries), cert
+        material lives as long as the connection object.
+        """
+        cached = self._client_cons.get(uuid)
+        if cached is not None:
+            return cached
         self.logger.debug("Trying to connect as %s", uuid)
-        data = self._retr(self.con.getConsumer, lambda res: res is not None, 1, True, self.portal_login, uuid)
-        tf_cert = tempfile.NamedTemporaryFile(delete=False, suffix=".pem")
-        tf_cert.write(data['idCert']['cert'])
-        tf_cert.close()
-        tf_key = tempfile.NamedTemporaryFile(delete=False, suffix=".pem")
-        tf_key.write(data['idCert']['key'])
-        tf_key.close()
-        con_client = connection.UEPConnection(self.candlepin_url, ssl_port=self.candlepin_port, insecure=self.insecure, cert_file=tf_cert.name, key_file=tf_key.name)
+        data = self._retr(self.con.getConsumer, lambda res: res is not None, 1, True, self._heal_login, uuid)
+        creds = PemCredentials(data['idCert']['cert'], data['idCert']['key'])
+        con_client = connection.UEPConnection(self.candlepin_url, ssl_port=self.candlepin_port, insecure=self.insecure,
+                                              cert_file=creds.cert_file, key_file=creds.key_file)
+        con_client.pem_credentials = creds
         self.logger.debug("Created client connection for %s", uuid)
-        return con_client
+        return self._client_cons.put(uuid, con_client)
+
+    def _entitlement_session(self, entitlement):
+        """ Get (cached) keep-alive session authenticated with entitlement certificate """
+        key = self._entitlement_serial(entitlement)
+        cached = self._ent_sessions.get(key)
+        if cached is not None:
+            return cached
+        cert = entitlement['certificates'][0]
+        creds = PemCredentials(cert['cert'], cert['key'])
+        sess = self._create_session()
+        sess.cert = (creds.cert_file, creds.key_file)
+        sess.pem_credentials = creds
+        return self._ent_sessions.put(key, sess)
+
+    @staticmethod
+    def _entitlement_serial(entitlement):
+        """ Get entitlement certificate serial (or cert itself) for use as a cache key """
+        cert = entitlement['certificates'][0]
+        return cert['serial']['serial'] if 'serial' in cert else cert['cert']
+
+    def _entitlement_paths(self, entitlement):
+        """
+        Get content path patterns for entitlement
+
+        Content sets are decoded from the certificate once, '$releasever'-like
+        variables match any single path component.
+        """
+        key = self._entitlement_serial(entitlement)
+        paths = self._ent_paths.get(key)
+        if paths is not None:
+            return paths
+        paths = []
+        try:
+            for content in certificate.create_from_pem(entitlement['certificates'][0]['cert']).content:
+                if not content.url:
+                    continue
+                path = content.url.rstrip('/')
+                prefix = path.split('$')[0]
+                pattern = re.compile(re.sub(r'\\\$\w+', '[^/]+', re.escape(path)) + '(/|$)')
+                paths.append((prefix, pattern))
+        except Exception, err:
+            self.logger.debug("Failed to decode content sets for entitlement %s: %s", entitlement.get('id'), err)
+        return self._ent_paths.put(key, paths)
+
+    def _match_entitlements(self, url, entitlements):
+        """
+        Order entitlements by content path match for url
+
+        Matching entitlements (most specific content path first) go first,
+        the rest is kept in original order as a fallback.
+        """
+        path = urlparse.urlparse(url).path
+        scored = []
+        for num, entitlement in enumerate(entitlements):
+            score = -1
+            for prefix, pattern in self._entitlement_paths(entitlement):
+                if path.startswith(prefix) and pattern.match(path):
+                    score = max(score, len(prefix))
+            scored.append((-score, num, entitlement))
+        scored.sort(key=lambda item: item[:2])
+        return [item[2] for item in scored]
 
     def get_client_compliance(self, uuid):
         """ Get client compliance status """
         self.logger.debug("Getting compliance status for %s", uuid)
         con_client = self.establish_client_con(uuid)
         assert con_client is not None
-        ret = self._retr(con_client.getCompliance, lambda res: res is not None, 1, True, self.portal_login, uuid)
-        os.unlink(con_client.cert_file)
-        os.unlink(con_client.key_file)
-        return ret
+        return self._retr(con_client.getCompliance, lambda res: res is not None, 1, True, self._heal_login, uuid)
 
     def get_client_entitlements(self, uuid):
         """ Get all client entitlements """
         con_client = self.establish_client_con(uuid)
         assert con_client is not None
-        if 'request_certs' in inspect.getargspec(self.con.getEntitlementList)[0]:
-            entitlements = self._retr(con_client.getEntitlementList, lambda res: res is not None, 1, True, self.portal_login, uuid, request_certs=True)
-        else:
-            entitlements = []
-            entitlements_list = self._retr(con_client.getEntitlementList, lambda res: res is not None, 1, True, self.portal_login, uuid)
-            for entitlement in entitlements_list:
-                entitlement_data = self._retr(con_client.getEntitlement, lambda res: res is not None, 1, True, self.portal_login, entitlement['id'])
-                entitlements.append(entitlement_data)
-        os.unlink(con_client.cert_file)
-        os.unlink(con_client.key_file)
-        return entitlements
+        return self._get_entitlements(con_client, uuid)
 
     def cdn_get_file(self, uuid, url, verify=False, entitlements=None):
-        """ Try accessing content on CDN """
+        """
+        Try accessing content on CDN
+
+        Entitlements providing matching content path are tried first, other
+        entitlements are probed one by one only if these fail.
+        """
         self.logger.debug("Checking content access, uuid: %s, url: %s", uuid, url)
-        con_client = self.establish_client_con(uuid)
         if entitlements is None:
             entitlements = self.get_client_entitlements(uuid)
         req = None
-        for entitlement in entitlements:
-            tcert = tempfile.NamedTemporaryFile(delete=False)
-            tkey = tempfile.NamedTemporaryFile(delete=False)
-            try:
-                tcert.write(entitlement['certificates'][0]['cert'])
-                tkey.write(entitlement['certificates'][0]['key'])
-                tcert.close()
-                tkey.close()
-                req = self._retr(requests.get, lambda res: res is not None, 1, True, None, url, verify=verify, cert=(tcert.name, tkey.name))
-            finally:
-                os.unlink(tcert.name)
-                os.unlink(tkey.name)
+        for entitlement in self._match_entitlements(url, entitlements):
+            sess = self._entitlement_session(entitlement)
+            req = self._retr(sess.get, lambda res: res is not None, 1, True, None, url, verify=verify, timeout=self.timeout, retry_policy='fast')
             if req.status_code == 200:
                 break
         return req
+
+    @staticmethod
+    def _parse_checksum(checksum):
+        """ Parse 'algo:hexdigest' or bare hexdigest (algo guessed by length), returns (algo, hexdigest) """
+        if checksum is None:
+            return 'sha256', None
+        if ':' in checksum:
+            algo, digest = checksum.split(':', 1)
+            try:
+                hashlib.new(algo.lower())
+            except ValueError:
+                raise SMPortalException("Unsupported checksum type %s" % algo)
+            return algo.lower(), digest.lower()
+        algos = {32: 'md5', 40: 'sha1', 64: 'sha256', 128: 'sha512'}
+        if not len(checksum) in algos:
+            raise SMPortalException("Can't guess checksum type for %s" % checksum)
+        return algos[len(checksum)], checksum.lower()
+
+    def _cdn_stream(self, sess, url, fname, algo, verify):
+        """
+        Stream url to fname (discard if None), returns (response, size, hexdigest)
+
+        Data goes to per-thread '.part' file first and is renamed when complete.
+        """
+        res = sess.get(url, verify=verify, stream=True, timeout=self.timeout)
+        if res.status_code != 200:
+            res.close()
+            return res, 0, None
+        digest = hashlib.new(algo)
+        size = 0
+        part = '%s.%s.part' % (fname, threading.current_thread().ident)
+        fd = open(part, 'wb') if fname is not None else None
+        complete = False
+        try:
+            for chunk in res.iter_content(chunk_size=self.cdn_chunk_size):
+                digest.update(chunk)
+                size += len(chunk)
+                if fd is not None:
+                    fd.write(chunk)
+            length = res.headers.get('content-length')
+            if length is not None and res.headers.get('content-encoding') in [None, 'identity'] and int(length) != size:
+                raise SMPortalException("Short read for %s: got %s of %s bytes" % (url, size, length))
+            if fd is not None:
+                fd.close()
+                os.rename(part, fname)
+            complete = True
+        finally:
+            res.close()
+            if fd is not None:
+                fd.close()
+                if not complete and os.path.exists(part):
+                    os.unlink(part)
+        return res, size, digest.hexdigest()
+
+    def cdn_fetch_files(self, uuid, urls, target_dir=None, verify=False, workers=4, report=None):
+        """
+        Download many CDN files with consumer's entitlements
+
+        urls is a list of urls or (url, checksum) pairs, checksum is
+        'algo:hexdigest' or bare hexdigest. Files are streamed to disk in
+        cdn_chunk_size chunks (target_dir/<url path>) or just checksummed
+        when target_dir is None. Keep-alive sessions are shared between
+        workers. Status of every url is appended to 'report' JSONL file as
+        soon as it is known. Returns list of status dicts in input order.
+        """
+        entitlements = self.get_client_entitlements(uuid)
+        report_lock = threading.Lock()
+        report_fd = open(report, 'a') if report is not None else None
+
+        def _fetch(item):
+            """ Fetch one url """
+            if isinstance(item, basestring):
+                url, checksum = item, None
+            else:
+                url, checksum = item
+            status = {'url': url, 'status': 'failed', 'http_status': None, 'size': 0, 'checksum': None, 'file': None, 'entitlement': None}
+            started = time.time()
+            fname = None
+            # pylint: disable=W0703
+            try:
+                algo, expected = self._parse_checksum(checksum)
+                if target_dir is not None:
+                    fname = os.path.join(target_dir, urlparse.urlparse(url).path.lstrip('/'))
+                    try:
+                        os.makedirs(os.path.dirname(fname))
+                    except OSError:
+                        if not os.path.isdir(os.path.dirname(fname)):
+                            raise
+                for entitlement in self._match_entitlements(url, entitlements):
+                    sess = self._entitlement_session(entitlement)
+                    res, size, hexdigest = self._retr(self._cdn_stream, lambda res: res[0].status_code < 500, 1, True, None, sess, url, fname, algo, verify,
+                                                      retry_policy='fast')
+                    status['http_status'] = res.status_code
+                    if res.status_code == 200:
+                        status.update({'size': size, 'checksum': '%s:%s' % (algo, hexdigest), 'file': fname, 'entitlement': entitlement.get('id')})
+                        if expected is not None and hexdigest != expected:
+                            status['status'] = 'checksum_mismatch'
+                            if fname is not None:
+                                os.unlink(fname)
+                                status['file'] = None
+                        else:
+                            status['status'] = 'ok'
+                        break
+            except Exception, err:
+                self.logger.error("Failed to fetch %s: %s", url, err)
+                status['error'] = str(err)
+            status['time'] = round(time.time() - started, 3)
+            if report_fd is not None:
+                with report_lock:
+                    report_fd.write(json.dumps(status) + '\n')
+                    report_fd.flush()
+            return status
+
+        try:
+            results = self._parallel(_fetch, urls, workers)
+        finally:
+            if report_fd is not None:
+                report_fd.close()
+        return [res for res, _ in results]
@@ -1,12 +1,20 @@
 """ Stageportal CLI """
 
 import argparse
+import atexit
+import json
 import logging
 import sys
 import pprint
 import random
 
 
+def dump_metrics(portal, metrics_file):
+    """ Write portal call metrics to JSON file """
+    with open(metrics_file, 'w') as fd:
+        json.dump(portal.metrics, fd, indent=2, sort_keys=True)
+
+
 def main():
     ''' Main '''
     lformat = '%(asctime)s %(levelname)s %(message)s'
@@ -33,6 +41,7 @@ def main():
                      'systems_register_classic',
                      'get_rhnclassic_channels',
                      'get_cdn_content',
+                     'get_cdn_content_bulk',
                      'get_pools',
                      'get_client_compliance']
 
@@ -46,6 +55,10 @@ def main():
     argparser.add_argument('--verbose', default=False, action='store_true', help="Verbose bode")
     argparser.add_argument('--debug', default=False, action='store_true', help="Debug bode")
     argparser.add_argument('--maxtries', type=int, default=20, help="Maximum retries count")
+    argparser.add_argument('--retry-policy', default='backoff', choices=['fixed', 'backoff', 'fast'],
+                           help="Retry policy: fixed (1 attempt per 'sleep' seconds), backoff (exponential with jitter), fast (short backoff, 60s deadline)")
+    argparser.add_argument('--retry-deadline', type=float, required=False, help="Maximum time (seconds) to spend retrying one call")
+    argparser.add_argument('--metrics-out', required=False, help="Write call metrics (counts, retries, latencies) to JSON file")
     argparser.add_argument('--portal', required=False, help='Portal access URL')
     argparser.add_argument('--api', required=False, help='API url (forcreating customers and adding subs')
     argparser.add_argument('--candlepin', required=False, help='Candlepin URL')
@@ -62,6 +75,7 @@ def main():
         argparser.add_argument('--sku-quantity', required=False, help='SKU quantity to add')
         argparser.add_argument('--sku-start-date', required=False, help='SKU start date')
         argparser.add_argument('--csv', required=False, help='CSV file with SKUs.')
+        argparser.add_argument('--workers', type=int, default=1, help='Number of SKUs to hock in parallel')
     if args.action in dist_actions:
         if args.action in ['distributor_create', 'satellite_create']:
             argparser.add_argument('--distributor-name', required=True, help='Distributor name')
@@ -73,10 +87,18 @@ def main():
             argparser.add_argument('--sub-id', required=False, help='sub id to attach to distributor')
             argparser.add_argument('--sub-quantity', required=False, help='sub quantity to attach to distributor')
 
+        if args.action == 'distributor_get_manifest':
+            argparser.add_argument('--save', required=False, help='Save manifest to specified file (temporary file if not set)')
+
         if args.action == 'distributor_detach_subscriptions':
             argparser.add_argument('--sub-ids', required=True, nargs='+', help='sub ids to detach from distributor (space separated list)')
+
+        if args.action in ['distributor_add_subscriptions', 'distributor_detach_subscriptions']:
+            argparser.add_argument('--workers', type=int, required=False, help='Number of pools to attach/detach in parallel (pool_size by default)')
     if args.action == 'heal_org':
-        argparser.add_argument('--org', required=False, help='Org to heal (standalone candlepin).')
+        argparser.add_argument('--org', required=False, nargs='+', help='Org(s) to heal (standalone candlepin), space separated list.')
+        argparser.add_argument('--wait', default=False, action='store_true', help="Wait for heal jobs to finish")
+        argparser.add_argument('--timeout', type=int, required=False, help="Maximum time (seconds) to wait for heal jobs")
     if args.action == 'system_register':
         argparser.add_argument('--org', required=False, help='Create systems within org (standalone candlepin).')
         argparser.add_argument('--system-name', help="System name")
@@ -96,6 +118,7 @@ def main():
     if args.action == 'systems_register':
         argparser.add_argument('--csv', required=True, help='CSV file with systems definition.')
         argparser.add_argument('--org', required=False, help='Create systems within org (standalone candlepin).')
+        argparser.add_argument('--workers', type=int, default=1, help='Number of systems to register in parallel')
     if args.action == 'subscriptions_check':
         argparser.add_argument('--sub-ids', required=True, nargs='+', help='sub ids to check (space separated list)')
     if args.action == 'systems_register_classic':
@@ -108,6 +131,13 @@ def main():
         argparser.add_argument('--url', required=True, help='CDN url')
         argparser.add_argument('--uuid', required=True, help='Consumer UUID')
         argparser.add_argument('--save', required=False, help='Save file to specified location')
+    if args.action == 'get_cdn_content_bulk':
+        argparser.add_argument('--uuid', required=True, help='Consumer UUID')
+        argparser.add_argument('--url', required=False, nargs='+', default=[], help='CDN urls (space separated list)')
+        argparser.add_argument('--urls-file', required=False, help="File with CDN urls, one 'url [checksum]' per line")
+        argparser.add_argument('--save', required=False, help='Save files under specified directory (only verify if not set)')
+        argparser.add_argument('--report', required=False, help='Append per-url status to JSONL file')
+        argparser.add_argument('--workers', type=int, default=4, help='Number of parallel downloads')
     if args.action == 'get_pools':
         pass
     if args.action == 'get_client_compliance':
@@ -129,12 +159,26 @@ def main():
         sys.stderr.write('You should specify --csv or --sku-id, --sku-quantity and --sku-start-date\n')
         sys.exit(1)
 
+    if args.action == 'get_cdn_content_bulk' and args.url == [] and args.urls_file is None:
+        sys.stderr.write('You should specify --url or --urls-file\n')
+        sys.exit(1)
+
+    from baseportal import RetryPolicy
+    retry_policy = RetryPolicy.preset(args.retry_policy, deadline=args.retry_deadline)
+
     if args.action in ['systems_register_classic', 'get_rhnclassic_channels']:
         from rhnclassic import RhnClassicPortal
-        portal = RhnClassicPortal(xmlrpc_url=args.xmlrpc, portal_url=args.portal, login=args.login, password=args.password, maxtries=args.maxtries, configfile=args.config)
+        portal = RhnClassicPortal(xmlrpc_url=args.xmlrpc, portal_url=args.portal, login=args.login, password=args.password, maxtries=args.maxtries, configfile=args.config,
+                                  retry_policy=retry_policy)
     else:
         from smportal import SMPortal
-        portal = SMPortal(api_url=args.api, candlepin_url=args.candlepin, portal_url=args.portal, login=args.login, password=args.password, maxtries=args.maxtries, configfile=args.config)
+        portal = SMPortal(api_url=args.api, candlepin_url=args.candlepin, portal_url=args.portal, login=args.login, password=args.password, maxtries=args.maxtries, configfile=args.config,
+                          retry_policy=retry_policy)
+        # release client connections and their cert material on exit
+        atexit.register(portal.close_client_cons)
+
+    if args.metrics_out is not None:
+        atexit.register(dump_metrics, portal, args.metrics_out)
 
     if args.action == 'user_create':
         res = portal.create_user()
@@ -144,8 +188,12 @@ def main():
         if args.csv is None:
             res = [portal.hock_sku(args.sku_id, args.sku_quantity, args.sku_start_date)]
         else:
-            res = portal.add_skus_csv(args.csv)
-        if portal is not None and args.password is not None and not (None in res):
+            res = portal.add_skus_csv(args.csv, workers=args.workers)
+        if None in res:
+            sys.stderr.write('Failed to add some SKUs\n')
+            sys.stdout.write('%s\n' % str(res))
+            sys.exit(1)
+        if portal is not None and args.password is not None:
             # Checking if subs appeared in candlepin
             res_check = portal.check_subscriptions(res)
             if res_check is None:
@@ -168,19 +216,24 @@ def main():
             res = pprint.pformat(subs)
         elif args.action == 'distributor_add_subscriptions':
             if args.all:
-                res = portal.distributor_attach_everything(distributor_uuid)
+                subscriptions = None
             else:
-                res = portal.distributor_attach_subscriptions(distributor_uuid, subscriptions=[{'id': args.sub_id, 'quantity': args.sub_quantity}])
+                subscriptions = [{'id': args.sub_id, 'quantity': args.sub_quantity}]
+            res = portal.distributor_attach_subscriptions(distributor_uuid, subscriptions=subscriptions, workers=args.workers, report=args.verbose)
+            if args.verbose:
+                res = pprint.pformat(res)
         elif args.action == 'distributor_detach_subscriptions':
-            res = portal.distributor_detach_subscriptions(distributor_uuid, subscriptions=args.sub_ids)
+            res = portal.distributor_detach_subscriptions(distributor_uuid, subscriptions=args.sub_ids, workers=args.workers, report=args.verbose)
+            if args.verbose:
+                res = pprint.pformat(res)
         elif args.action == 'distributor_delete':
             res = portal.delete_distributor(distributor_uuid)
         elif args.action == 'distributor_get_manifest':
-            res = portal.distributor_download_manifest(distributor_uuid)
+            res = portal.distributor_download_manifest(distributor_uuid, target=args.save)
         elif args.action == 'satellite_get_certificate':
             res = portal.satellite_download_cert(distributor_uuid)
     elif args.action == 'systems_register':
-        res = portal.create_systems(args.csv, org=args.org)
+        res = portal.create_systems(args.csv, org=args.org, workers=args.workers)
         if res is not None and not args.verbose:
             res = "<Response [200]>"
         elif res is not None:
@@ -225,9 +278,17 @@ def main():
     elif args.action == 'subscriptions_check':
         res = portal.check_subscriptions(args.sub_ids)
     elif args.action == 'heal_org':
-        res = portal.heal_entire_org()
-        if not args.verbose:
+        owner = args.org
+        if owner is not None and len(owner) == 1:
+            owner = owner[0]
+        res = portal.heal_entire_org(owner=owner, wait=args.wait, timeout=args.timeout)
+        if res is None or (isinstance(res, list) and None in res):
+            sys.stdout.write('%s\n' % pprint.pformat(res))
+            sys.exit(1)
+        if not args.verbose or args.wait:
             res = pprint.pformat(res)
+        elif isinstance(res, list):
+            res = pprint.pformat([req.content for req in res])
         elif res is not None:
             res = pprint.pformat(res.content)
     elif args.action == 'get_client_compliance':
@@ -247,13 +308,32 @@ def main():
             with open(fname, 'w') as fd:
                 fd.write(res.content)
                 sys.stdout.write('%s downloaded\n' % fname)
+    elif args.action == 'get_cdn_content_bulk':
+        urls = list(args.url)
+        if args.urls_file is not None:
+            with open(args.urls_file) as fd:
+                for line in fd:
+                    line = line.strip()
+                    if line == '' or line.startswith('#'):
+                        continue
+                    fields = line.split()
+                    urls.append((fields[0], fields[1] if len(fields) > 1 else None))
+        statuses = portal.cdn_fetch_files(args.uuid, urls, target_dir=args.save, workers=args.workers, report=args.report)
+        failed = [status for status in statuses if status['status'] != 'ok']
+        if args.verbose:
+            res = pprint.pformat(statuses)
+        else:
+            res = pprint.pformat({'total': len(statuses), 'ok': len(statuses) - len(failed), 'failed': [status['url'] for status in failed]})
+        if failed:
+            sys.stdout.write('%s\n' % res)
+            sys.exit(1)
     elif args.action == 'get_pools':
-        pools = portal.get_pools()
-        if pools is not None and args.verbose:
-            res = pprint.pformat(pools)
-        elif pools is not None:
+        if args.verbose:
+            pools = portal.get_pools()
+            res = pprint.pformat(pools) if pools is not None else None
+        else:
             res = []
-            for pool in pools:
+            for pool in portal.iter_pools():
                 res.append({'id': pool['id'],
                             'productId': pool['productId'],
                             'quantity': pool['quantity'],
@@ -266,8 +346,6 @@ def main():
                             'type': pool['type']
                         })
             res = pprint.pformat(res)
-        else:
-	    res = None
     else:
         sys.stderr.write('Unknown action: %s\n' % args.action)
         sys.exit(1)